@@ -3,15 +3,1823 @@ import random
 import sqlite3
 from datetime import datetime, timedelta, UTC
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
 import time
 import logging
 import traceback
 import sys
 import math
+import threading
+import heapq
+import bisect
+import itertools
+import hashlib
+import hmac
+import json
+import re
+from functools import lru_cache
+from array import array
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from typing import NamedTuple
+
+@lru_cache(maxsize=512)
+def normalize_sql(sql):
+    # Метка запроса для метрик: без переносов и с одним ? вместо списков IN (?, ?, ...)
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', sql)
+    return sql[:120]
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Время каждого execute/executemany уходит в метрики с меткой нормализованного
+    # SQL, поэтому многозапросные функции видны по отдельным запросам
+    def _timed(self, method, sql, parameters):
+        metrics = self.connection.metrics
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        except sqlite3.Error:
+            if metrics:
+                metrics.inc('bot_db_statement_errors_total', statement=normalize_sql(sql))
+            raise
+        finally:
+            if metrics:
+                metrics.observe('bot_db_statement_seconds', time.perf_counter() - started, statement=normalize_sql(sql))
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._timed(super().executemany, sql, parameters)
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Соединение, все запросы которого идут через InstrumentedCursor
+    metrics = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+class Database:
+    # Долгоживущие соединения с SQLite: по одному на поток, открываются один раз
+    def __init__(self, path, cache_size_kb=16384, mmap_size=268435456, statement_cache=256, busy_timeout=5.0,
+                 max_workers=4, max_concurrency=8, metrics=None):
+        self.path = path
+        self.metrics = metrics
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache = statement_cache
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._opened = 0
+        self._checkouts = 0
+        self._reuses = 0
+        # Отдельный пул потоков, чтобы запросы к БД не блокировали цикл событий
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self._semaphore = None
+        self._waiting = 0
+        self._max_waiting = 0
+        self._in_flight = 0
+        self._completed = 0
+        self._wait_time_total = 0.0
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            cached_statements=self.statement_cache,
+            check_same_thread=False,
+            factory=InstrumentedConnection
+        )
+        conn.metrics = self.metrics
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        with self._lock:
+            self._connections.append(conn)
+            self._opened += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        # Как и sqlite3.connect() в with: commit при успехе, rollback при ошибке
+        conn = getattr(self._local, 'conn', None)
+        with self._lock:
+            self._checkouts += 1
+            if conn is not None:
+                self._reuses += 1
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        with conn:
+            yield conn
+
+    async def run(self, fn, *args):
+        # Выполняет синхронную функцию работы с БД в пуле потоков
+        return await self._run(fn.__name__, fn, *args)
+
+    async def _run(self, label, fn, *args):
+        # label — имя функции или нормализованный SQL для метрик
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        queued_at = time.monotonic()
+        self._waiting += 1
+        self._max_waiting = max(self._max_waiting, self._waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        self._wait_time_total += time.monotonic() - queued_at
+        self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, lambda: fn(*args))
+        except Exception:
+            if self.metrics:
+                self.metrics.inc('bot_db_errors_total', query=label)
+            raise
+        finally:
+            if self.metrics:
+                self.metrics.observe('bot_db_query_seconds', time.perf_counter() - started, query=label)
+            self._in_flight -= 1
+            self._completed += 1
+            self._semaphore.release()
+
+    def _fetchone(self, sql, params):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _execute(self, sql, params):
+        with self.connection() as conn:
+            return conn.execute(sql, params).rowcount
+
+    async def fetchone(self, sql, params=()):
+        return await self._run(normalize_sql(sql), self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self._run(normalize_sql(sql), self._fetchall, sql, params)
+
+    async def execute(self, sql, params=()):
+        return await self._run(normalize_sql(sql), self._execute, sql, params)
+
+    def migrate(self, migrations):
+        with self.connection() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(migrations, start=1):
+            if number <= version:
+                continue
+            # Каждая миграция и номер версии применяются в одной транзакции
+            with self.connection() as conn:
+                conn.execute('BEGIN')
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+            print(f"Применена миграция БД №{number}: {migration.__name__}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections_open': len(self._connections),
+                'connections_opened_total': self._opened,
+                'checkouts_total': self._checkouts,
+                'reuses_total': self._reuses,
+                'statement_cache_size': self.statement_cache,
+                'cache_size_kb': self.cache_size_kb,
+                'mmap_size': self.mmap_size,
+                'executor_workers': self.max_workers,
+                'max_concurrency': self.max_concurrency,
+                'queue_depth': self._waiting,
+                'queue_depth_max': self._max_waiting,
+                'in_flight': self._in_flight,
+                'completed_total': self._completed,
+                'queue_wait_seconds_total': self._wait_time_total,
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                print(f"Ошибка при закрытии соединения с БД: {e}")
+        self._local = threading.local()
+
+def migrate_001_initial_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS Users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT NOT NULL,
+            telegram_tag TEXT,
+            unique_code TEXT UNIQUE,
+            animal_code TEXT,
+            role TEXT CHECK(role IN ('Волонтёр', 'Организатор', 'Пользователь')) DEFAULT 'Пользователь',
+            full_name TEXT -- добавили запись ФИО
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS VolunteerGroups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            volunteer_group TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES Users(id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS SystemActions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            author_id INTEGER,
+            action TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (author_id) REFERENCES Users(id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ContestLogs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_tag TEXT,
+            animal_code TEXT,
+            condition1 BOOLEAN DEFAULT FALSE,
+            condition2 BOOLEAN DEFAULT FALSE,
+            condition3 BOOLEAN DEFAULT FALSE,
+            condition4 BOOLEAN DEFAULT FALSE,
+            condition5 BOOLEAN DEFAULT FALSE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS UserMainMessages (
+            telegram_id INTEGER PRIMARY KEY,
+            main_message_id INTEGER NOT NULL,
+            map_message_id INTEGER,
+            event_message_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS RaffleResults (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            winner_id INTEGER,
+            raffle_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_current BOOLEAN DEFAULT 1,
+            position_number INTEGER,
+            FOREIGN KEY (winner_id) REFERENCES Users(id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS UserCommands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            command TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES Users(id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS UserMutes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            end_time DATETIME,
+            reason TEXT,
+            FOREIGN KEY (user_id) REFERENCES Users(id)
+        )
+    ''')
+
+def migrate_002_raffle_position_number(conn):
+    # Старые базы создавались без position_number
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(RaffleResults)')}
+    if 'position_number' not in columns:
+        conn.execute('ALTER TABLE RaffleResults ADD COLUMN position_number INTEGER')
+
+def migrate_003_hot_path_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram_tag ON Users(telegram_tag)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_animal_code ON Users(animal_code)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_contest_logs_telegram_tag ON ContestLogs(telegram_tag)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_volunteer_groups_user_id ON VolunteerGroups(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_commands_user_time ON UserCommands(user_id, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_mutes_user_end ON UserMutes(user_id, end_time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_raffle_results_current ON RaffleResults(is_current, position_number)')
+
+def migrate_004_contest_logs_user_id(conn):
+    # Прогресс привязывается к Users.id вместо текстового telegram_tag
+    conn.execute('ALTER TABLE ContestLogs ADD COLUMN user_id INTEGER REFERENCES Users(id)')
+    conn.execute('''
+        UPDATE ContestLogs
+        SET user_id = (SELECT MIN(u.id) FROM Users u WHERE u.telegram_tag = ContestLogs.telegram_tag)
+    ''')
+    conn.execute('''
+        UPDATE ContestLogs
+        SET user_id = NULL
+        WHERE user_id IS NOT NULL
+        AND id NOT IN (SELECT MIN(id) FROM ContestLogs WHERE user_id IS NOT NULL GROUP BY user_id)
+    ''')
+    conn.execute('''
+        INSERT INTO ContestLogs (user_id, telegram_tag, animal_code, condition1, condition2, condition3, condition4, condition5)
+        SELECT u.id, u.telegram_tag, u.animal_code, 0, 0, 0, 0, 0
+        FROM Users u
+        WHERE NOT EXISTS (SELECT 1 FROM ContestLogs x WHERE x.user_id = u.id)
+    ''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_contest_logs_user_id ON ContestLogs(user_id)')
+
+    # Общая строка пользователей с одинаковым тегом (например, все "@Unknown")
+    # содержит отметки их всех, поэтому их прогресс восстанавливается по журналу
+    shared = [row[0] for row in conn.execute('''
+        SELECT id FROM Users
+        WHERE telegram_tag IN (
+            SELECT telegram_tag FROM Users
+            WHERE telegram_tag IS NOT NULL
+            GROUP BY telegram_tag HAVING COUNT(*) > 1
+        )
+    ''')]
+    if not shared:
+        return
+    progress = replay_mark_log(conn, shared)
+    conn.executemany('''
+        UPDATE ContestLogs
+        SET condition1 = ?, condition2 = ?, condition3 = ?, condition4 = ?, condition5 = ?
+        WHERE user_id = ?
+    ''', [
+        tuple(int(f'condition{idx}' in progress.get(user_id, ())) for idx in range(1, 6)) + (user_id,)
+        for user_id in shared
+    ])
+    print(
+        f"Миграция №4: прогресс {len(shared)} пользователей с общим тегом восстановлен по журналу "
+        f"(с отметками: {len(progress)}), user_id: {', '.join(map(str, shared))}"
+    )
+
+# Записи SystemActions об отметках и их отмене во всех форматах, которые писал
+# бот: (регулярное выражение, True — отметка / False — отмена). Отмены
+# проверяются первыми, цель — код или позывной.
+MARK_LOG_PATTERNS = [
+    (re.compile(r'отменил отметку активности «(?P<activity>.+)» для пользователя (?P<target>.+)$'), False),
+    (re.compile(r'^Отменена отметка активности «(?P<activity>.+)» для пользователя (?P<target>.+)$'), False),
+    (re.compile(r'^Отменена отметка (?P<field>condition\d) для пользователя .*\((?P<target>[^()]+)\)$'), False),
+    (re.compile(r'^Отменена отметка (?P<field>condition\d) для пользователя (?P<target>.+)$'), False),
+    (re.compile(r'отметил активность «(?P<activity>.+)» для пользователя (?P<target>.+)$'), True),
+    (re.compile(r'отметил (?P<field>condition\d) для пользователя .*\((?P<target>[^()]+)\)$'), True),
+]
+
+def replay_marks(conn, user_ids=None):
+    # Проигрывает журнал действий по порядку и возвращает {(user_id,
+    # conditionN): author_id} для указанных (None — всех) пользователей в
+    # порядке постановки действующих отметок. Повторная отметка уже
+    # отмеченного ничего не меняет, автор и место остаются прежними
+    fields = {name: f'condition{key[3:]}' for key, name in Bot.MAP_DOT_NAME.items()}
+    targets = {}
+    for user_id, unique_code, animal_code in conn.execute('SELECT id, unique_code, animal_code FROM Users'):
+        for key in (unique_code, animal_code):
+            if key:
+                targets.setdefault(str(key).lower().replace('ё', 'е'), user_id)
+
+    wanted = None if user_ids is None else set(user_ids)
+    marks = {}
+    for author_id, action in conn.execute('SELECT author_id, action FROM SystemActions ORDER BY id'):
+        for pattern, marked in MARK_LOG_PATTERNS:
+            match = pattern.search(action or '')
+            if match:
+                break
+        else:
+            continue
+        groups = match.groupdict()
+        field = groups.get('field') or fields.get(groups.get('activity'))
+        user_id = targets.get(groups['target'].strip().lower().replace('ё', 'е'))
+        if field is None or user_id is None or (wanted is not None and user_id not in wanted):
+            continue
+        if marked:
+            marks.setdefault((user_id, field), author_id)
+        else:
+            marks.pop((user_id, field), None)
+    return marks
+
+def replay_mark_log(conn, user_ids=None):
+    # То же, сгруппированное по пользователям: {user_id: {conditionN: author_id}}
+    progress = {}
+    for (user_id, field), author_id in replay_marks(conn, user_ids).items():
+        progress.setdefault(user_id, {})[field] = author_id
+    return progress
+
+def migrate_005_animal_counters(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS AnimalCounters (
+            animal TEXT PRIMARY KEY,
+            next_number INTEGER NOT NULL
+        )
+    ''')
+    # Счётчики продолжают нумерацию уже выданных позывных
+    next_numbers = {}
+    for (animal_code,) in conn.execute('''
+        SELECT animal_code FROM Users WHERE animal_code IS NOT NULL
+        UNION
+        SELECT animal_code FROM ContestLogs WHERE animal_code IS NOT NULL
+    '''):
+        animal, _, number = animal_code.rpartition('#')
+        if animal and number.isdigit():
+            next_numbers[animal] = max(next_numbers.get(animal, 1), int(number) + 1)
+    conn.executemany(
+        'INSERT OR REPLACE INTO AnimalCounters (animal, next_number) VALUES (?, ?)',
+        next_numbers.items()
+    )
+
+def migrate_006_code_pool(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS CodePool (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            code_length INTEGER NOT NULL,
+            seed INTEGER NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def migrate_007_media_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS MediaCache (
+            path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL
+        )
+    ''')
+
+def migrate_008_retention_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS UserCommandRollups (
+            user_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            command TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, hour, command)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS UserMutesArchive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            start_time DATETIME,
+            end_time DATETIME,
+            reason TEXT,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_commands_time ON UserCommands(timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_mutes_end ON UserMutes(end_time)')
+
+def migrate_009_contest_logs_progress(conn):
+    # Пять столбцов conditionN сворачиваются в битовую маску progress
+    # (бит N-1 — активность N) и поддерживаемый счётчик completed_count
+    conn.execute('''
+        CREATE TABLE ContestLogs_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES Users(id),
+            telegram_tag TEXT,
+            animal_code TEXT,
+            progress INTEGER NOT NULL DEFAULT 0,
+            completed_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO ContestLogs_new (id, user_id, telegram_tag, animal_code, progress, completed_count)
+        SELECT
+            id, user_id, telegram_tag, animal_code,
+            (COALESCE(condition1, 0) != 0) * 1 + (COALESCE(condition2, 0) != 0) * 2 +
+            (COALESCE(condition3, 0) != 0) * 4 + (COALESCE(condition4, 0) != 0) * 8 +
+            (COALESCE(condition5, 0) != 0) * 16,
+            (COALESCE(condition1, 0) != 0) + (COALESCE(condition2, 0) != 0) +
+            (COALESCE(condition3, 0) != 0) + (COALESCE(condition4, 0) != 0) +
+            (COALESCE(condition5, 0) != 0)
+        FROM ContestLogs
+    ''')
+    conn.execute('DROP TABLE ContestLogs')
+    conn.execute('ALTER TABLE ContestLogs_new RENAME TO ContestLogs')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_contest_logs_telegram_tag ON ContestLogs(telegram_tag)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_contest_logs_user_id ON ContestLogs(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_contest_logs_completed ON ContestLogs(completed_count)')
+
+def migrate_010_raffle_draws(conn):
+    # Каждый розыгрыш получает номер, а его победители хранят призовую
+    # категорию, сид генератора и размер выборки допущенных участников
+    conn.execute('ALTER TABLE RaffleResults ADD COLUMN draw_id INTEGER')
+    conn.execute('ALTER TABLE RaffleResults ADD COLUMN prize_tier TEXT')
+    conn.execute('ALTER TABLE RaffleResults ADD COLUMN seed INTEGER')
+    conn.execute('ALTER TABLE RaffleResults ADD COLUMN eligible_count INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_raffle_results_draw ON RaffleResults(draw_id)')
+    # Допущенные к розыгрышу читаются по индексу в порядке user_id без сортировки
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_contest_logs_completed_user ON ContestLogs(completed_count, user_id)')
+
+def standing_marks(conn):
+    # Все выставленные в ContestLogs.progress биты как (user_id, бит,
+    # author_id) в порядке прохождения: сначала по журналу, затем биты без
+    # записи в журнале (author_id = None) в порядке ContestLogs
+    progress = dict(conn.execute('SELECT user_id, progress FROM ContestLogs WHERE user_id IS NOT NULL ORDER BY id'))
+    marks = []
+    seen = set()
+    for (user_id, field), author_id in replay_marks(conn).items():
+        bit = 1 << (int(field[len('condition'):]) - 1)
+        if progress.get(user_id, 0) & bit:
+            marks.append((user_id, bit, author_id))
+            seen.add((user_id, bit))
+    for user_id, value in progress.items():
+        for index in range(value.bit_length()):
+            bit = 1 << index
+            if value & bit and (user_id, bit) not in seen:
+                marks.append((user_id, bit, None))
+    return marks
+
+def migrate_011_volunteer_marks(conn):
+    # Каждый выставленный бит прогресса с автором и порядковым номером
+    # (id — порядок прохождения активностей) и счётчик действующих отметок
+    # волонтёра: при снятии отметки счётчик уменьшается у того, кто её
+    # поставил. Холостые и снятые отметки не учитываются
+    conn.execute('ALTER TABLE VolunteerGroups ADD COLUMN marks_count INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ContestMarks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            bit INTEGER NOT NULL,
+            author_id INTEGER,
+            UNIQUE (user_id, bit)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_contest_marks_author ON ContestMarks(author_id)')
+    conn.executemany(
+        'INSERT INTO ContestMarks (user_id, bit, author_id) VALUES (?, ?, ?)',
+        standing_marks(conn)
+    )
+    conn.execute('''
+        UPDATE VolunteerGroups
+        SET marks_count = (SELECT COUNT(*) FROM ContestMarks cm WHERE cm.author_id = VolunteerGroups.user_id)
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_volunteer_groups_group ON VolunteerGroups(volunteer_group, id)')
+
+# Отметка и снятие активности меняют бит и счётчик одним запросом, счётчик
+# меняется только если бит действительно переключился.
+# Параметры: (бит, user_id, бит).
+SET_PROGRESS_SQL = '''
+    UPDATE ContestLogs
+    SET progress = progress | ?, completed_count = completed_count + 1
+    WHERE user_id = ? AND progress & ? = 0
+    RETURNING user_id, progress
+'''
+CLEAR_PROGRESS_SQL = '''
+    UPDATE ContestLogs
+    SET progress = progress & ~?, completed_count = completed_count - 1
+    WHERE user_id = ? AND progress & ? != 0
+    RETURNING user_id, progress
+'''
+
+# Порядковый номер миграции = значение PRAGMA user_version после её применения.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    migrate_001_initial_schema,
+    migrate_002_raffle_position_number,
+    migrate_003_hot_path_indexes,
+    migrate_004_contest_logs_user_id,
+    migrate_005_animal_counters,
+    migrate_006_code_pool,
+    migrate_007_media_cache,
+    migrate_008_retention_tables,
+    migrate_009_contest_logs_progress,
+    migrate_010_raffle_draws,
+    migrate_011_volunteer_marks,
+]
+
+def reservoir_sample(items, k, rng):
+    # Равномерная выборка k элементов из потока за один проход (алгоритм R).
+    # Возвращает выборку и число просмотренных элементов.
+    reservoir = []
+    seen = 0
+    for item in items:
+        seen += 1
+        if len(reservoir) < k:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(seen)
+            if j < k:
+                reservoir[j] = item
+    # Первые k элементов попадают в резервуар по порядку, поэтому места
+    # распределяются отдельным перемешиванием
+    rng.shuffle(reservoir)
+    return reservoir, seen
+
+class RateLimiter:
+    # Скользящее окно команд на пользователя в памяти: O(1) на проверку,
+    # неактивные пользователи вытесняются по давности последней команды
+    def __init__(self, window, threshold, max_users=100000):
+        self.window = window
+        self.threshold = threshold
+        self.max_users = max_users
+        self._events = OrderedDict()
+        self._evicted = 0
+
+    def hit(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        events = self._events.get(user_id)
+        if events is None:
+            # Хранить больше threshold + 1 отметок не нужно: мьют уже сработает
+            events = deque(maxlen=self.threshold + 1)
+            self._events[user_id] = events
+        else:
+            self._events.move_to_end(user_id)
+        events.append(now)
+        while events[0] <= now - self.window:
+            events.popleft()
+        self._evict(now)
+        return len(events)
+
+    def reset(self, user_id):
+        self._events.pop(user_id, None)
+
+    def _evict(self, now):
+        while self._events:
+            user_id, events = next(iter(self._events.items()))
+            if len(self._events) <= self.max_users and events[-1] > now - self.window:
+                break
+            self._events.popitem(last=False)
+            self._evicted += 1
+
+    def stats(self):
+        return {
+            'tracked_users': len(self._events),
+            'evicted_total': self._evicted,
+        }
+
+class CallSignAllocator:
+    # Позывные вида "лиса#N": отдельный счётчик на каждое животное,
+    # в памяти и в таблице AnimalCounters
+    def __init__(self, animals):
+        self.animals = animals
+        self._next = {}
+        self._lock = threading.Lock()
+        self._allocated = 0
+
+    def load(self, conn):
+        with self._lock:
+            self._next = dict(conn.execute('SELECT animal, next_number FROM AnimalCounters').fetchall())
+
+    def allocate(self, conn):
+        animal = random.choice(self.animals)
+        with self._lock:
+            number = self._next.get(animal, 1)
+            self._next[animal] = number + 1
+            self._allocated += 1
+        # Номер уже занят в памяти; при откате транзакции он просто пропускается
+        conn.execute('''
+            INSERT INTO AnimalCounters (animal, next_number) VALUES (?, ?)
+            ON CONFLICT(animal) DO UPDATE SET next_number = MAX(next_number, excluded.next_number)
+        ''', (animal, number + 1))
+        return f"{animal}#{number}"
+
+    def stats(self):
+        with self._lock:
+            return {
+                'animals': len(self._next),
+                'allocated_total': self._allocated,
+            }
+
+class UniqueCodePool:
+    # Заранее перемешанная перестановка всех кодов заданной длины: выдача
+    # кода — сдвиг курсора, а сид и курсор хранятся в таблице CodePool.
+    # Когда коды заканчиваются, длина кода увеличивается на единицу.
+    def __init__(self, code_length):
+        self.code_length = code_length
+        self._lock = threading.Lock()
+        self._length = None
+        self._seed = None
+        self._cursor = 0
+        self._permutation = array('I')
+        self._allocated = 0
+        self._skipped = 0
+
+    def load(self, conn):
+        row = conn.execute('SELECT code_length, seed, cursor FROM CodePool WHERE id = 1').fetchone()
+        with self._lock:
+            if row is None or row[0] < self.code_length:
+                self._start(conn, self.code_length if row is None else max(row[0] + 1, self.code_length))
+            else:
+                self._length, self._seed, self._cursor = row
+                self._permutation = self._build(self._length, self._seed)
+
+    def _build(self, length, seed):
+        permutation = array('I', range(10 ** length))
+        random.Random(seed).shuffle(permutation)
+        return permutation
+
+    def _start(self, conn, length):
+        self._length = length
+        self._seed = random.SystemRandom().getrandbits(63)
+        self._cursor = 0
+        self._permutation = self._build(length, self._seed)
+        conn.execute('''
+            INSERT OR REPLACE INTO CodePool (id, code_length, seed, cursor)
+            VALUES (1, ?, ?, 0)
+        ''', (self._length, self._seed))
+
+    def allocate(self, conn):
+        with self._lock:
+            while True:
+                if self._cursor >= len(self._permutation):
+                    self._start(conn, self._length + 1)
+                code = str(self._permutation[self._cursor]).zfill(self._length)
+                self._cursor += 1
+                # Коды, выданные случайно до появления пула, пропускаются
+                if conn.execute('SELECT 1 FROM Users WHERE unique_code = ?', (code,)).fetchone() is None:
+                    break
+                self._skipped += 1
+            self._allocated += 1
+            conn.execute('''
+                UPDATE CodePool SET cursor = MAX(cursor, ?)
+                WHERE id = 1 AND seed = ?
+            ''', (self._cursor, self._seed))
+            return code
+
+    def stats(self):
+        with self._lock:
+            return {
+                'code_length': self._length,
+                'cursor': self._cursor,
+                'remaining': len(self._permutation) - self._cursor,
+                'allocated_total': self._allocated,
+                'skipped_total': self._skipped,
+            }
+
+class CallSignIndex:
+    # Биграммный индекс по кодам и позывным: поиск подстроки пересекает
+    # списки пользователей по каждой биграмме запроса вместо LIKE '%q%'
+    GRAM = 2
+
+    def __init__(self, normalize):
+        self.normalize = normalize
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._postings = {}
+        self._searches = 0
+
+    def _grams(self, text):
+        return {text[i:i + self.GRAM] for i in range(len(text) - self.GRAM + 1)}
+
+    def load(self, conn):
+        for user_id, unique_code, animal_code in conn.execute('SELECT id, unique_code, animal_code FROM Users'):
+            self.add(user_id, unique_code, animal_code)
+
+    def add(self, user_id, *keys):
+        keys = tuple(self.normalize(key) for key in keys if key)
+        with self._lock:
+            self._entries[user_id] = keys
+            for key in keys:
+                for gram in self._grams(key):
+                    self._postings.setdefault(gram, set()).add(user_id)
+
+    def search(self, query, limit=5):
+        query = self.normalize(query)
+        grams = self._grams(query)
+        if not grams:
+            return []
+        with self._lock:
+            self._searches += 1
+            postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            # Биграммы могут совпасть и вразброс, поэтому кандидаты проверяются
+            matches = [
+                (not any(key.startswith(query) for key in keys), user_id)
+                for user_id in candidates
+                for keys in (self._entries[user_id],)
+                if any(query in key for key in keys)
+            ]
+        return [user_id for _, user_id in heapq.nsmallest(limit, matches)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'grams': len(self._postings),
+                'searches_total': self._searches,
+            }
+
+class UserProfile(NamedTuple):
+    id: int
+    role: str
+    telegram_tag: str | None
+    unique_code: str | None
+    animal_code: str | None
+    volunteer_group: str | None
+    main_message_id: int | None
+    map_message_id: int | None
+    event_message_id: int | None
+
+class ProfileCache:
+    # Ограниченный LRU-кэш профилей по telegram_id. Пока профиль читается из
+    # БД, изменения этого пользователя увеличивают его версию, чтобы не
+    # сохранить профиль, прочитанный до них. Версии хранятся только для
+    # пользователей с незавершённым чтением.
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def get(self, telegram_id):
+        with self._lock:
+            profile = self._profiles.get(telegram_id)
+            if profile is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._profiles.move_to_end(telegram_id)
+            return profile
+
+    def begin_load(self, telegram_id):
+        # Возвращает версию, которую нужно передать в put() после чтения
+        with self._lock:
+            entry = self._loading.setdefault(telegram_id, [0, 0])
+            entry[0] += 1
+            return entry[1]
+
+    def put(self, telegram_id, profile, version):
+        # Завершает чтение, начатое begin_load(); profile=None только завершает
+        with self._lock:
+            entry = self._loading[telegram_id]
+            entry[0] -= 1
+            if not entry[0]:
+                del self._loading[telegram_id]
+            if profile is None or version != entry[1]:
+                return
+            self._profiles[telegram_id] = profile
+            self._profiles.move_to_end(telegram_id)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+    def _bump(self, telegram_id):
+        entry = self._loading.get(telegram_id)
+        if entry is not None:
+            entry[1] += 1
+
+    def update(self, telegram_id, **fields):
+        with self._lock:
+            self._bump(telegram_id)
+            profile = self._profiles.get(telegram_id)
+            if profile is not None:
+                self._profiles[telegram_id] = profile._replace(**fields)
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._bump(telegram_id)
+            self._invalidations += 1
+            self._profiles.pop(telegram_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._profiles),
+                'loading': len(self._loading),
+                'hits_total': self._hits,
+                'misses_total': self._misses,
+                'invalidations_total': self._invalidations,
+            }
+
+class MediaCache:
+    # file_id файлов, уже загруженных в Telegram. Хэш содержимого
+    # пересчитывается только при изменении размера или mtime файла.
+    def __init__(self):
+        self._file_ids = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._uploads = 0
+
+    def load(self, conn):
+        with self._lock:
+            for path, content_hash, file_id in conn.execute('SELECT path, content_hash, file_id FROM MediaCache'):
+                self._file_ids[path] = (content_hash, file_id)
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(65536), b''):
+                digest.update(chunk)
+        self._hashes[path] = (key, digest.hexdigest())
+        return digest.hexdigest()
+
+    def get(self, path, content_hash):
+        with self._lock:
+            entry = self._file_ids.get(path)
+            if entry and entry[0] == content_hash:
+                self._hits += 1
+                return entry[1]
+            return None
+
+    def store(self, conn, path, content_hash, file_id):
+        conn.execute('''
+            INSERT INTO MediaCache (path, content_hash, file_id) VALUES (?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET content_hash = excluded.content_hash, file_id = excluded.file_id
+        ''', (path, content_hash, file_id))
+        with self._lock:
+            self._uploads += 1
+            self._file_ids[path] = (content_hash, file_id)
+
+    def forget(self, path):
+        with self._lock:
+            self._file_ids.pop(path, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._file_ids),
+                'hits_total': self._hits,
+                'uploads_total': self._uploads,
+            }
+
+class HttpServer:
+    # Минимальный HTTP/1.1-сервер на asyncio для вебхука и служебных
+    # эндпоинтов. TLS не поддерживается: сервер рассчитан на работу за
+    # обратным прокси, который терминирует HTTPS.
+    MAX_BODY_SIZE = 1024 * 1024
+    READ_TIMEOUT = 10  # Секунды на чтение строки или тела запроса
+    IDLE_TIMEOUT = 75  # Секунды простоя keep-alive соединения до закрытия
+    REASONS = {
+        200: 'OK',
+        400: 'Bad Request',
+        403: 'Forbidden',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+        413: 'Payload Too Large',
+        500: 'Internal Server Error',
+        503: 'Service Unavailable',
+    }
+
+    def __init__(self):
+        self._routes = {}
+        self._server = None
+        self._writers = set()
+
+    def route(self, method, path, handler):
+        # handler(headers, body) -> (status, headers, body)
+        self._routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # Открытые keep-alive соединения закрываются явно, иначе
+            # wait_closed() в Python 3.12+ ждёт их до таймаута простоя
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.READ_TIMEOUT)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > self.MAX_BODY_SIZE:
+                    await self._respond(writer, 413, {}, b'', False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), self.READ_TIMEOUT) if length else b''
+
+                status, response_headers, payload = await self._dispatch(method, target.split('?', 1)[0], headers, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, response_headers, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, method, path, headers, body):
+        handler = self._routes.get((method, path))
+        if handler is None:
+            status = 405 if any(route_path == path for _, route_path in self._routes) else 404
+            return status, {}, b''
+        try:
+            return await handler(headers, body)
+        except Exception as e:
+            print(f"Ошибка при обработке HTTP-запроса {method} {path}: {e}")
+            return 500, {}, b''
+
+    async def _respond(self, writer, status, headers, body, keep_alive):
+        lines = [f"HTTP/1.1 {status} {self.REASONS.get(status, '')}"]
+        headers = {'Content-Length': str(len(body)), 'Connection': 'keep-alive' if keep_alive else 'close', **headers}
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+class AuditSink:
+    # Отложенная запись SystemActions: действия копятся в памяти и пишутся
+    # одной транзакцией executemany по размеру буфера или по таймеру
+    def __init__(self, db, max_buffer=200):
+        self.db = db
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._max_depth = 0
+        self._flushes = 0
+        self._written = 0
+        self._flush_seconds_total = 0.0
+        self._last_flush_seconds = 0.0
+
+    def add(self, telegram_id, action):
+        # Возвращает True, когда буфер пора сбросить
+        timestamp = datetime.now(UTC).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._buffer.append((action, timestamp, telegram_id))
+            self._max_depth = max(self._max_depth, len(self._buffer))
+            return len(self._buffer) >= self.max_buffer
+
+    def write_pending(self, conn):
+        # Пишет буфер в транзакции conn и возвращает записанное. Код, который
+        # сам вставляет строки в SystemActions, вызывает это первым в своей
+        # транзакции, чтобы id журнала шли в порядке событий. Извлечение и
+        # вставка под одной блокировкой: вставка берёт блокировку записи БД,
+        # и следующий сброс ждёт фиксации этой транзакции.
+        with self._write_lock:
+            with self._lock:
+                entries, self._buffer = self._buffer, []
+            if entries:
+                try:
+                    conn.executemany('''
+                        INSERT INTO SystemActions (author_id, action, timestamp)
+                        SELECT id, ?, ? FROM Users WHERE telegram_id = ?
+                    ''', entries)
+                except sqlite3.Error:
+                    self.restore(entries)
+                    raise
+        return entries
+
+    def restore(self, entries):
+        # Записи из откатившейся транзакции возвращаются в начало буфера
+        if entries:
+            with self._lock:
+                self._buffer[:0] = entries
+
+    def flush_sync(self):
+        started = time.monotonic()
+        entries = []
+        try:
+            with self.db.connection() as conn:
+                entries = self.write_pending(conn)
+        except sqlite3.Error:
+            self.restore(entries)
+            raise
+        if not entries:
+            return 0
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._flushes += 1
+            self._written += len(entries)
+            self._flush_seconds_total += elapsed
+            self._last_flush_seconds = elapsed
+        return len(entries)
+
+    async def flush(self):
+        return await self.db.run(self.flush_sync)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'buffer_depth': len(self._buffer),
+                'buffer_depth_max': self._max_depth,
+                'flushes_total': self._flushes,
+                'written_total': self._written,
+                'flush_seconds_total': self._flush_seconds_total,
+                'last_flush_seconds': self._last_flush_seconds,
+            }
+
+class Leaderboard:
+    # Таблица лидеров в памяти: корзины по числу пройденных активностей
+    # (внутри корзины — по user_id, то есть в порядке регистрации) и списки
+    # по каждой активности в порядке прохождения. Обновляется при каждой
+    # отметке, страница читается за O(offset + limit).
+    def __init__(self, activity_bits):
+        self.activity_bits = list(activity_bits)
+        self._lock = threading.Lock()
+        self._progress = {}
+        self._info = {}
+        self._by_count = [[] for _ in range(len(self.activity_bits) + 1)]
+        self._by_activity = {bit: OrderedDict() for bit in self.activity_bits}
+
+    def load(self, conn):
+        # Порядок прохождения восстанавливается по ContestMarks.id: отметки
+        # пишутся в той же транзакции, что и обновление таблицы
+        with self._lock:
+            for user_id, progress, animal_code, telegram_tag in conn.execute('''
+                SELECT user_id, progress, animal_code, telegram_tag
+                FROM ContestLogs
+                WHERE user_id IS NOT NULL
+                ORDER BY user_id
+            '''):
+                self._info[user_id] = (animal_code, telegram_tag)
+                self._progress[user_id] = progress
+                self._by_count[bin(progress).count('1')].append(user_id)
+            for user_id, bit in conn.execute('SELECT user_id, bit FROM ContestMarks ORDER BY id'):
+                if bit in self._by_activity and self._progress.get(user_id, 0) & bit:
+                    self._by_activity[bit][user_id] = None
+
+    def add(self, user_id, progress, animal_code, telegram_tag):
+        with self._lock:
+            self._info[user_id] = (animal_code, telegram_tag)
+        self.update(user_id, progress)
+
+    def update(self, user_id, progress):
+        with self._lock:
+            old = self._progress.get(user_id)
+            if old == progress:
+                return
+            if old is not None:
+                bucket = self._by_count[bin(old).count('1')]
+                del bucket[bisect.bisect_left(bucket, user_id)]
+            bisect.insort(self._by_count[bin(progress).count('1')], user_id)
+            for bit in self.activity_bits:
+                if progress & bit and not (old or 0) & bit:
+                    self._by_activity[bit][user_id] = None
+                elif (old or 0) & bit and not progress & bit:
+                    del self._by_activity[bit][user_id]
+            self._progress[user_id] = progress
+
+    def top(self, offset, limit):
+        # [(animal_code, telegram_tag, completed_count)], лучшие первыми
+        page = []
+        with self._lock:
+            for count in range(len(self._by_count) - 1, -1, -1):
+                bucket = self._by_count[count]
+                if offset >= len(bucket):
+                    offset -= len(bucket)
+                    continue
+                for user_id in bucket[offset:offset + limit - len(page)]:
+                    page.append((*self._info.get(user_id, (None, None)), count))
+                offset = 0
+                if len(page) == limit:
+                    break
+            return page
+
+    def activity(self, bit, offset, limit):
+        # Прошедшие активность в порядке прохождения
+        with self._lock:
+            return [
+                (*self._info.get(user_id, (None, None)), bin(self._progress[user_id]).count('1'))
+                for user_id in itertools.islice(self._by_activity[bit], offset, offset + limit)
+            ]
+
+    def total(self, bit=None):
+        with self._lock:
+            return len(self._progress) if bit is None else len(self._by_activity[bit])
+
+class LatencyHistogram:
+    # Гистограмма задержек с фиксированными верхними границами корзин (секунды)
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def snapshot(self):
+        # Накопительные счётчики по границам, как в формате Prometheus
+        with self._lock:
+            counts = list(itertools.accumulate(self._counts))
+            return {
+                'buckets': list(zip(self.buckets + (math.inf,), counts)),
+                'sum': self._sum,
+                'count': counts[-1],
+            }
+
+    def quantile(self, q):
+        # Верхняя граница корзины, в которую попадает квантиль q
+        snapshot = self.snapshot()
+        rank = q * snapshot['count']
+        for bound, count in snapshot['buckets']:
+            if count and count >= rank:
+                return bound
+        return None
+
+class CallbackRoute(NamedTuple):
+    name: str
+    handler: object
+    parse: object = None
+    needs_main_message: bool = True
+
+class CallbackRouter:
+    # Маршрутизация callback_data: точные значения ищутся в словаре, префиксы —
+    # в префиксном дереве (выигрывает самый длинный). Для каждого маршрута
+    # копится гистограмма времени обработки.
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self.latency = {}
+
+    def exact(self, data, handler, needs_main_message=True):
+        self._exact[data] = CallbackRoute(data, handler, None, needs_main_message)
+        self.latency[data] = LatencyHistogram()
+
+    def prefix(self, prefix, handler, parse=str, needs_main_message=True):
+        # parse превращает остаток строки в аргументы обработчика; кортеж
+        # раскрывается в несколько аргументов, None — без аргументов
+        node = self._trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = CallbackRoute(prefix + '*', handler, parse, needs_main_message)
+        self.latency[prefix + '*'] = LatencyHistogram()
+
+    def resolve(self, data):
+        # Возвращает (маршрут, аргументы) или (None, None)
+        route = self._exact.get(data)
+        if route is not None:
+            return route, ()
+        node, match, match_length = self._trie, None, 0
+        for length, char in enumerate(data, 1):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match, match_length = node[None], length
+        if match is None:
+            return None, None
+        if match.parse is None:
+            return match, ()
+        try:
+            payload = match.parse(data[match_length:])
+        except ValueError:
+            return None, None
+        return match, payload if isinstance(payload, tuple) else (payload,)
+
+    async def call(self, route, args, update, context):
+        started = time.perf_counter()
+        try:
+            return await route.handler(update, context, *args)
+        finally:
+            self.latency[route.name].observe(time.perf_counter() - started)
+
+    def stats(self):
+        return {name: histogram.snapshot() for name, histogram in self.latency.items()}
+
+class ScreenRenderer:
+    # Главное меню, статус и подпись к карте зависят только от роли и маски
+    # прогресса, поэтому клавиатуры и шаблоны собираются один раз на все
+    # сочетания, а при показе подставляются только коды пользователя
+    ROLES = ('Пользователь', 'Волонтёр', 'Организатор')
+
+    def __init__(self, activities):
+        # activities — список (бит, название, ссылка) в порядке активностей
+        self.activities = list(activities)
+        self.total = len(self.activities)
+        self.misses = 0
+        self._main = {}
+        self._status = {}
+        self._map = {}
+        for progress in range(1 << self.total):
+            self._status[progress] = self._build_status(progress)
+            self._map[progress] = self._build_map(progress)
+            for role in self.ROLES:
+                self._main[role, progress] = self._build_main(role, progress)
+        self.status_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🗺 Карта активностей", callback_data='get_map')],
+            [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]
+        ])
+
+    def _completed(self, progress):
+        return sum(1 for bit, _, _ in self.activities if progress & bit)
+
+    def _build_main(self, role, progress):
+        completed = self._completed(progress)
+        text = (
+            "👋 Добро пожаловать в нашего бота!\n\n"
+            "🏷 Ваш позывной: {animal_code}\n"
+            "🔢 Ваш код: {unique_code}"
+        )
+        buttons = [[InlineKeyboardButton("О мероприятии", callback_data='get_event1')]]
+
+        if role == 'Пользователь':
+            buttons.append([InlineKeyboardButton("📊 Мой статус", callback_data='show_status')])
+            if completed < self.total:
+                buttons.append([InlineKeyboardButton("Получить карту", callback_data='get_map')])
+                text += f"\n🎈 Вы прошли {completed} из {self.total} активностей."
+            else:
+                text += "\n🎉 Вы прошли все активности"
+        elif role == 'Организатор':
+            buttons.append([InlineKeyboardButton("Получить статистику", callback_data='get_stat')])
+            buttons.append([InlineKeyboardButton("👥 Список волонтёров", callback_data='show_volunteers')])
+            buttons.append([InlineKeyboardButton("Добавить волонтера", callback_data='add_volunteer')])
+            buttons.append([InlineKeyboardButton("Отметить условие", callback_data='mark_condition')])
+            buttons.append([InlineKeyboardButton("Отменить отметку", callback_data='unmark_condition')])
+            buttons.append([InlineKeyboardButton("🎲 Провести розыгрыш", callback_data='run_raffle')])
+        elif role == 'Волонтёр':
+            buttons.append([InlineKeyboardButton("Отметить условие", callback_data='mark_condition')])
+            buttons.append([InlineKeyboardButton("Отменить отметку", callback_data='unmark_condition')])
+
+        return text, InlineKeyboardMarkup(buttons)
+
+    def _build_status(self, progress):
+        completed = self._completed(progress)
+        text = "✨ <b>Ваш текущий статус:</b>\n\n"
+        text += "🏷 Позывной: <code>{animal_code}</code>\n"
+        text += "🔢 Код: <code>{unique_code}</code>\n\n"
+        text += f"📊 Прогресс: {completed}/{self.total} активностей\n"
+        text += "".join('🟢' if progress & bit else '⚪' for bit, _, _ in self.activities) + "\n\n"
+
+        text += "<b>Статус активностей:</b>\n"
+        for bit, name, _ in self.activities:
+            text += f"{'✅' if progress & bit else '❌'} {name}\n"
+
+        if completed < self.total:
+            text += "\n💡 <i>Подсказка: Нажмите кнопку «Карта активностей» "
+            text += "чтобы увидеть расположение непройденных точек.</i>"
+        else:
+            text += "\n🎉 <b>Поздравляем! Вы прошли все активности!</b>"
+        return text
+
+    def _build_map(self, progress):
+        links = '\n'
+        for idx, (bit, name, url) in enumerate(self.activities, 1):
+            if not progress & bit:
+                links += f"<b>{name}</b> {'-'*idx} <a href='{url}'>Показать</a>\n"
+        return f"🗺 <b>Карта с активностями:</b>\n{links}"
+
+    def main_menu(self, role, progress, animal_code, unique_code):
+        screen = self._main.get((role, progress))
+        if screen is None:
+            self.misses += 1
+            screen = self._build_main(role, progress)
+        text, reply_markup = screen
+        return text.format(
+            animal_code=animal_code if animal_code else 'Не назначен',
+            unique_code=unique_code if unique_code else 'Не назначен'
+        ), reply_markup
+
+    def status(self, progress, animal_code, unique_code):
+        return self._status[progress].format(animal_code=animal_code, unique_code=unique_code)
+
+    def map_caption(self, progress):
+        return self._map[progress]
+
+    def stats(self):
+        return {
+            'main_screens': len(self._main),
+            'status_screens': len(self._status),
+            'map_screens': len(self._map),
+            'misses': self.misses,
+        }
+
+class EditFingerprints:
+    # Отпечатки последнего отрисованного содержимого сообщений (текст, разметка,
+    # режим разбора) по (chat_id, message_id) с LRU-вытеснением. Повторная
+    # отправка того же содержимого пропускается без обращения к Telegram
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._fingerprints = OrderedDict()
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.sent = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    @staticmethod
+    def fingerprint(text, reply_markup=None, parse_mode=None):
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (text, reply_markup.to_json() if reply_markup else '', parse_mode or ''):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.digest()
+
+    def is_current(self, key, fingerprint):
+        with self._lock:
+            if self._fingerprints.get(key) != fingerprint:
+                return False
+            self._fingerprints.move_to_end(key)
+            self.skipped += 1
+            return True
+
+    def remember(self, key, fingerprint):
+        with self._lock:
+            self._fingerprints[key] = fingerprint
+            self._fingerprints.move_to_end(key)
+            while len(self._fingerprints) > self.max_size:
+                self._fingerprints.popitem(last=False)
+                self.evictions += 1
+
+    def forget(self, key):
+        with self._lock:
+            self._fingerprints.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._fingerprints),
+                'skipped': self.skipped,
+                'sent': self.sent,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+            }
+
+class TokenBucket:
+    # Ведро токенов: rate токенов в секунду, не больше capacity в запасе.
+    # Токен можно взять в долг — тогда reserve() вернёт, сколько ждать
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class OutboundScheduler(BaseRateLimiter):
+    # Планировщик исходящих запросов к Bot API: общее ведро токенов на бота,
+    # отдельные вёдра на отправку в каждый чат, приоритет интерактивных ответов над фоновыми
+    # (удаление сообщений) и автоматический повтор после RetryAfter.
+    # Приоритет можно задать явно через rate_limit_args у методов бота
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    BACKGROUND_ENDPOINTS = frozenset({'deleteMessage', 'deleteMessages'})
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate, chat_rate, group_rate, chat_burst, max_retries):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._paused_until = 0.0
+        self.queue_wait = LatencyHistogram()
+        self.latency = {}
+        self.requests = 0
+        self.retries = 0
+        self.retry_after_seconds = 0.0
+        self.queue_depth_max = 0
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                # Полные вёдра ничем не отличаются от новых — их можно забыть
+                for key in [key for key, value in self._chats.items() if value.idle()]:
+                    del self._chats[key]
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _dispatch(self):
+        # Единственный потребитель общего ведра: токены выдаются ожидающим
+        # в порядке приоритета, а внутри приоритета — в порядке очереди
+        while True:
+            while not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+
+    async def _acquire(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self.queue_depth_max = max(self.queue_depth_max, len(self._waiters))
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if isinstance(rate_limit_args, int):
+            priority = rate_limit_args
+        elif endpoint in self.BACKGROUND_ENDPOINTS:
+            priority = self.BACKGROUND
+        else:
+            priority = self.INTERACTIVE
+        chat_id = data.get('chat_id')
+
+        attempt = 0
+        while True:
+            queued = time.perf_counter()
+            # Лимиты Telegram на чат касаются отправки сообщений: правки и
+            # удаления тратят только общее ведро в порядке приоритета
+            if chat_id is not None and endpoint.startswith('send'):
+                delay = self._chat_bucket(chat_id).reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+            await self._acquire(priority)
+            started = time.perf_counter()
+            self.queue_wait.observe(started - queued)
+            self.requests += 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                # Флуд-контроль Telegram действует на весь бот: держим паузу для всех
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                self.retries += 1
+                self.retry_after_seconds += retry_after
+            finally:
+                histogram = self.latency.get(endpoint)
+                if histogram is None:
+                    histogram = self.latency[endpoint] = LatencyHistogram()
+                histogram.observe(time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'retry_after_seconds': self.retry_after_seconds,
+            'queue_depth': len(self._waiters),
+            'queue_depth_max': self.queue_depth_max,
+            'chat_buckets': len(self._chats),
+            'queue_wait': self.queue_wait.snapshot(),
+            'latency': {endpoint: histogram.snapshot() for endpoint, histogram in self.latency.items()},
+        }
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей обрабатываются параллельно, но не больше
+    # max_concurrent_updates одновременно; обновления одного пользователя идут
+    # строго по очереди. Семафор библиотеки в process_update берётся раньше
+    # do_process_update, поэтому ему задан заведомо большой лимит, а настоящий
+    # держит свой семафор, который берётся уже после блокировки пользователя:
+    # очередь одного пользователя не занимает слоты остальных
+    LIBRARY_SLOTS = 65536
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self.LIBRARY_SLOTS)
+        self.max_updates = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+        self.in_flight = 0
+        self.in_flight_max = 0
+        self.processed = 0
+        self.contended = 0
+        self.lock_wait = LatencyHistogram()
+        self.slot_wait = LatencyHistogram()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return await self._run(coroutine, time.perf_counter())
+
+        # Запись [блокировка, число ожидающих] живёт, пока у пользователя есть обновления
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            queued = time.perf_counter()
+            if entry[0].locked():
+                self.contended += 1
+            async with entry[0]:
+                acquired = time.perf_counter()
+                self.lock_wait.observe(acquired - queued)
+                await self._run(coroutine, acquired)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+
+    async def _run(self, coroutine, queued):
+        async with self._slots:
+            self.slot_wait.observe(time.perf_counter() - queued)
+            self.in_flight += 1
+            self.in_flight_max = max(self.in_flight_max, self.in_flight)
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+
+    def stats(self):
+        return {
+            'max_concurrent_updates': self.max_updates,
+            'in_flight': self.in_flight,
+            'in_flight_max': self.in_flight_max,
+            'processed': self.processed,
+            'contended': self.contended,
+            'users_locked': len(self._locks),
+            'lock_wait': self.lock_wait.snapshot(),
+            'slot_wait': self.slot_wait.snapshot(),
+        }
+
+class MetricsRegistry:
+    # Счётчики и гистограммы задержек с метками. Гистограммы и stats()
+    # компонентов, которые уже считают сами, подключаются как источники и
+    # читаются только при экспорте в текстовом формате Prometheus
+    def __init__(self):
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._histogram_sources = []
+        self._gauge_sources = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = LatencyHistogram()
+        histogram.observe(value)
+
+    def add_histograms(self, name, source, label=None):
+        # source() -> LatencyHistogram или {значение метки label: LatencyHistogram}
+        self._histogram_sources.append((name, source, label))
+
+    def add_gauges(self, prefix, source):
+        # source() -> словарь stats(); числовые значения экспортируются как gauge
+        self._gauge_sources.append((prefix, source))
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for name, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    @staticmethod
+    def _value(value):
+        if value == math.inf:
+            return '+Inf'
+        return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def _histogram_lines(self, lines, name, series):
+        self._header(lines, name, 'histogram')
+        for labels, histogram in series:
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot['buckets']:
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', self._value(bound))])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {self._value(snapshot['sum'])}")
+            lines.append(f"{name}_count{self._labels(labels)} {snapshot['count']}")
+
+    def render(self):
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: dict(series) for name, series in self._histograms.items()}
+        lines = []
+        for name, series in sorted(counters.items()):
+            self._header(lines, name, 'counter')
+            for labels, value in series.items():
+                lines.append(f"{name}{self._labels(labels)} {self._value(value)}")
+        for name, series in sorted(histograms.items()):
+            self._histogram_lines(lines, name, series.items())
+        for name, source, label in self._histogram_sources:
+            histograms = source()
+            if label is None:
+                self._histogram_lines(lines, name, [((), histograms)])
+            else:
+                self._histogram_lines(lines, name, [(((label, value),), histogram) for value, histogram in histograms.items()])
+        for prefix, source in self._gauge_sources:
+            for key, value in source().items():
+                if isinstance(value, (bool, int, float)):
+                    name = f"{prefix}_{key}"
+                    self._header(lines, name, 'gauge')
+                    lines.append(f"{name} {self._value(value)}")
+        return '\n'.join(lines) + '\n'
+
+class MuteRegistry:
+    # Активные мьюты в памяти; истёкшие снимаются через min-heap по времени окончания
+    def __init__(self):
+        self._mutes = {}
+        self._heap = []
+
+    def add(self, user_id, end_time, reason):
+        current = self._mutes.get(user_id)
+        if current is not None and current[0] >= end_time:
+            return
+        self._mutes[user_id] = (end_time, reason)
+        heapq.heappush(self._heap, (end_time, user_id))
+
+    def get(self, user_id, now=None):
+        self._expire(datetime.now(UTC) if now is None else now)
+        return self._mutes.get(user_id)
+
+    def _expire(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            end_time, user_id = heapq.heappop(self._heap)
+            current = self._mutes.get(user_id)
+            # В куче могут лежать устаревшие записи продлённых мьютов
+            if current is not None and current[0] <= now:
+                del self._mutes[user_id]
+
+    def stats(self):
+        return {
+            'active_mutes': len(self._mutes),
+            'heap_size': len(self._heap),
+        }
 
 class Bot:
     VOLUNTEER_GROUPS = {'А', 'Б', 'В', 'Г', 'Д'}
+    ACTIVITIES_TOTAL = 5
+    CONDITION_BITS = {
+        'condition1': 1,
+        'condition2': 2,
+        'condition3': 4,
+        'condition4': 8,
+        'condition5': 16
+    }
     GROUP_TO_CONDITION = {
         'А': 'condition1',
         'Б': 'condition2',
@@ -41,11 +1849,108 @@ class Bot:
     COMMAND_COOLDOWN = 5  # Секунды между коммандами
     MUTE_THRESHOLD = 7  # Количество лимита команд перед мьютом
     MUTE_DURATION = 300  # 15 мин мьюта команды
+    RATE_LIMIT_WINDOW = 60  # Окно подсчёта команд для мьюта (секунды)
+    RATE_LIMIT_MAX_USERS = 100000  # Максимум пользователей в памяти ограничителя
+    PROFILE_CACHE_SIZE = 10000  # Максимум профилей пользователей в кэше
+    EDIT_FINGERPRINT_CACHE_SIZE = 20000  # Максимум отпечатков отредактированных сообщений
+    PERSIST_USER_COMMANDS = False  # Сохранять ли каждую команду в UserCommands
+    AUDIT_BUFFER_SIZE = 200  # Записей SystemActions в буфере до принудительной записи
+    AUDIT_FLUSH_INTERVAL = 5  # Период записи буфера SystemActions (секунды)
+    COMMAND_RETENTION = 3600  # Сколько хранить сырые строки UserCommands (секунды)
+    MUTE_RETENTION = 24 * 3600  # Через сколько после окончания мьют уходит в архив (секунды)
+    MAINTENANCE_INTERVAL = 600  # Период обслуживания таблиц (секунды)
+    MAINTENANCE_BATCH_SIZE = 500  # Строк в одной транзакции обслуживания
+    # Призовые категории розыгрыша в порядке мест: (название, число призов)
+    RAFFLE_PRIZE_TIERS = (
+        ('Главный приз', 1),
+        ('Второй приз', 4),
+        ('Поощрительный приз', 10)
+    )
+    STAT_PAGE_SIZE = 10  # Строк таблицы лидеров на странице /stat
+    VOLUNTEERS_PAGE_SIZE = 10  # Волонтёров на странице списка
+    MARK_BATCH_LIMIT = 50  # Максимум кодов в одной команде /mark
+    UNIQUE_CODE_LENGTH = 5  # Минимальная длина числового кода участника
+    # Режим получения обновлений: 'polling' или 'webhook'. Без BOT_WEBHOOK_URL
+    # вебхук не регистрируется в Telegram (удобно для локальных тестов).
+    # Вебхук без BOT_WEBHOOK_SECRET не запускается: иначе любой, кто достучится
+    # до порта, сможет прислать обновление от имени организатора. По умолчанию
+    # сервер слушает только локальный адрес за обратным прокси
+    UPDATE_MODE = os.environ.get('BOT_UPDATE_MODE', 'polling')
+    WEBHOOK_URL = os.environ.get('BOT_WEBHOOK_URL')
+    WEBHOOK_LISTEN = os.environ.get('BOT_WEBHOOK_LISTEN', '127.0.0.1')
+    WEBHOOK_PORT = int(os.environ.get('BOT_WEBHOOK_PORT', '8080'))
+    WEBHOOK_PATH = os.environ.get('BOT_WEBHOOK_PATH', '/telegram')
+    WEBHOOK_SECRET = os.environ.get('BOT_WEBHOOK_SECRET')
+    UPDATE_QUEUE_SIZE = 1000  # Максимум необработанных обновлений в очереди
+    WEBHOOK_RETRY_AFTER = 1  # Retry-After (секунды) при переполненной очереди
+    OUTBOUND_GLOBAL_RATE = 28  # Запросов к Bot API в секунду на всего бота (лимит Telegram ~30)
+    OUTBOUND_CHAT_RATE = 1  # Запросов в секунду в личный чат
+    OUTBOUND_GROUP_RATE = 20 / 60  # Запросов в секунду в групповой чат
+    OUTBOUND_CHAT_BURST = 3  # Запас запросов на один чат для коротких всплесков
+    OUTBOUND_MAX_RETRIES = 3  # Повторы запроса после RetryAfter
+    MAX_CONCURRENT_UPDATES = 32  # Обновлений, обрабатываемых одновременно
+    # Локальный эндпоинт /metrics в формате Prometheus; по умолчанию выключен
+    # (порт 0), включается заданием BOT_METRICS_PORT, например 9464
+    METRICS_LISTEN = os.environ.get('BOT_METRICS_LISTEN', '127.0.0.1')
+    METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT', '0'))
+    DB_PATH = 'bot_database.db'
+    DB_CACHE_SIZE_KB = 16384  # Размер страничного кэша SQLite на соединение (КиБ)
+    DB_MMAP_SIZE = 256 * 1024 * 1024  # Размер memory-mapped I/O (байт)
+    DB_STATEMENT_CACHE = 256  # Кэш подготовленных запросов на соединение
+    DB_BUSY_TIMEOUT = 5.0  # Секунды ожидания блокировки БД
+    DB_MAX_WORKERS = 4  # Потоки пула для запросов к БД
+    DB_MAX_CONCURRENCY = 8  # Максимум одновременных запросов к БД из обработчиков
 
     def __init__(self):
         self.token = self.get_token()
+        self.metrics = MetricsRegistry()
+        self.db = Database(
+            self.DB_PATH,
+            cache_size_kb=self.DB_CACHE_SIZE_KB,
+            mmap_size=self.DB_MMAP_SIZE,
+            statement_cache=self.DB_STATEMENT_CACHE,
+            busy_timeout=self.DB_BUSY_TIMEOUT,
+            max_workers=self.DB_MAX_WORKERS,
+            max_concurrency=self.DB_MAX_CONCURRENCY,
+            metrics=self.metrics
+        )
         self.init_db()
         self.message_id = None
+        self.rate_limiter = RateLimiter(self.RATE_LIMIT_WINDOW, self.MUTE_THRESHOLD, self.RATE_LIMIT_MAX_USERS)
+        self.background_tasks = set()
+        self.periodic_tasks = []
+        self.profiles = ProfileCache(self.PROFILE_CACHE_SIZE)
+        self.edits = EditFingerprints(self.EDIT_FINGERPRINT_CACHE_SIZE)
+        self.updates = UserOrderedUpdateProcessor(self.MAX_CONCURRENT_UPDATES)
+        self.outbound = OutboundScheduler(
+            self.OUTBOUND_GLOBAL_RATE,
+            self.OUTBOUND_CHAT_RATE,
+            self.OUTBOUND_GROUP_RATE,
+            self.OUTBOUND_CHAT_BURST,
+            self.OUTBOUND_MAX_RETRIES
+        )
+        self.audit = AuditSink(self.db, self.AUDIT_BUFFER_SIZE)
+        self.closed = False
+        self.mutes = MuteRegistry()
+        self.load_mutes()
+        self.call_signs = CallSignAllocator([self.standardize_call_sign(animal) for animal in self.ANIMALS])
+        self.unique_codes = UniqueCodePool(self.UNIQUE_CODE_LENGTH)
+        self.call_sign_index = CallSignIndex(self.standardize_call_sign)
+        self.media = MediaCache()
+        self.leaderboard = Leaderboard(self.CONDITION_BITS.values())
+        self.callback_router = self.build_callback_router()
+        self.metrics_server = None
+        self.screens = ScreenRenderer(
+            (bit, self.MAP_DOT_NAME[f'Акт{idx}'], self.MAP_DOT[f'Акт{idx}'])
+            for idx, bit in enumerate(self.CONDITION_BITS.values(), 1)
+        )
+        self.register_metrics()
+        with self.db.connection() as conn:
+            self.call_signs.load(conn)
+            self.unique_codes.load(conn)
+            self.call_sign_index.load(conn)
+            self.media.load(conn)
+            self.leaderboard.load(conn)
 
     def get_token(self):
         try:
@@ -58,109 +1963,26 @@ class Bot:
         return dt.strftime('%Y-%m-%d %H:%M:%S')
     sqlite3.register_adapter(datetime, adapt_datetime)
     def init_db(self):
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.executescript('''
-                CREATE TABLE IF NOT EXISTS Users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER UNIQUE NOT NULL,
-                    username TEXT NOT NULL,
-                    telegram_tag TEXT,
-                    unique_code TEXT UNIQUE,
-                    animal_code TEXT,
-                    role TEXT CHECK(role IN ('Волонтёр', 'Организатор', 'Пользователь')) DEFAULT 'Пользователь',
-                    full_name TEXT -- добавили запись ФИО
-                );
-                CREATE TABLE IF NOT EXISTS VolunteerGroups (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    volunteer_group TEXT NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES Users(id)
-                );
-                CREATE TABLE IF NOT EXISTS SystemActions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    author_id INTEGER,
-                    action TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (author_id) REFERENCES Users(id)
-                );
-                CREATE TABLE IF NOT EXISTS ContestLogs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_tag TEXT,
-                    animal_code TEXT,
-                    condition1 BOOLEAN DEFAULT FALSE,
-                    condition2 BOOLEAN DEFAULT FALSE,
-                    condition3 BOOLEAN DEFAULT FALSE,
-                    condition4 BOOLEAN DEFAULT FALSE,
-                    condition5 BOOLEAN DEFAULT FALSE
-                );
-                CREATE TABLE IF NOT EXISTS UserMainMessages (
-                    telegram_id INTEGER PRIMARY KEY,
-                    main_message_id INTEGER NOT NULL,
-                    map_message_id INTEGER,
-                    event_message_id INTEGER
-                );
-                CREATE TABLE IF NOT EXISTS RaffleResults (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    winner_id INTEGER,
-                    raffle_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    is_current BOOLEAN DEFAULT 1,
-                    position_number INTEGER,
-                    FOREIGN KEY (winner_id) REFERENCES Users(id)
-                );
-                CREATE TABLE IF NOT EXISTS UserCommands (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    command TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES Users(id)
-                );
-                CREATE TABLE IF NOT EXISTS UserMutes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    end_time DATETIME,
-                    reason TEXT,
-                    FOREIGN KEY (user_id) REFERENCES Users(id)
-                );
-            ''')
-            conn.commit()
+        self.db.migrate(MIGRATIONS)
 
-    def crd_msg(self, conditions):
-        links = '\n'
-        for idx, condition in enumerate(conditions, start=1):
-            if condition == 0:
-                name = self.MAP_DOT_NAME[f'Акт{idx}']
-                url = self.MAP_DOT[f'Акт{idx}']
-                links += f"<b>{name}</b> {'-'*idx} <a href='{url}'>Показать</a>\n"
-        
-        msg = f"🗺 <b>Карта с активностями:</b>\n{links}"
-        return msg
-
-    def welc_msg(self, animal_code, unique_code):
-        msg = (
-            f"👋 Добро пожаловать в нашего бота!\n\n"
-            f"🏷 Ваш позывной: {animal_code if animal_code else 'Не назначен'}\n"
-            f"🔢 Ваш код: {unique_code if unique_code else 'Не назначен'}"
-        )
-        return msg
+    def crd_msg(self, progress):
+        return self.screens.map_caption(progress)
+
+    async def render_main_menu(self, user_id):
+        role = await self.get_user_role(user_id)
+        animal_code, unique_code, progress = await self.db.fetchone('''
+            SELECT cl.animal_code, u.unique_code, cl.progress
+            FROM ContestLogs cl
+            JOIN Users u ON u.id = cl.user_id
+            WHERE u.telegram_id = ?
+        ''', (user_id,))
+        return self.screens.main_menu(role, progress, animal_code, unique_code)
 
     def standardize_call_sign(self, call_sign):
         return call_sign.lower().replace("ё", "е")
 
-    def generate_animal_code(self):
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT animal_code FROM ContestLogs WHERE animal_code IS NOT NULL')
-            existing_codes = {code[0] for code in cursor.fetchall() if code[0]}
-            counter = 1
-            while True:
-                animal = random.choice(self.ANIMALS)
-                new_code = f"{animal}#{counter}"
-                new_code = self.standardize_call_sign(new_code)
-                if new_code not in existing_codes:
-                    return new_code
-                counter += 1
+    def generate_animal_code(self, conn):
+        return self.call_signs.allocate(conn)
 
     def get_activity_name(self, condition_field: str) -> str:
         try:
@@ -169,65 +1991,111 @@ class Bot:
         except (ValueError, IndexError):
             return condition_field
 
-    def generate_unique_code(self):
-        return ''.join(random.choices('0123456789', k=5))
+    def generate_unique_code(self, conn):
+        return self.unique_codes.allocate(conn)
 
     def add_user(self, telegram_id, username, telegram_tag=None, role='Пользователь', full_name=None):
-        with sqlite3.connect('bot_database.db') as conn:
+        with self.db.connection() as conn:
             cursor = conn.cursor()
             if telegram_tag is None:
                 telegram_tag = f"@{username}" if username else None
-            unique_code = self.generate_unique_code()
-            animal_code = self.generate_animal_code()
-            cursor.execute('''
-                INSERT OR IGNORE INTO Users (telegram_id, username, telegram_tag, unique_code, animal_code, role, full_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (telegram_id, username, telegram_tag, unique_code, animal_code, role, full_name))
-            user_id = cursor.lastrowid or cursor.execute(
-                'SELECT id FROM Users WHERE telegram_id = ?',
+            existing = cursor.execute(
+                'SELECT id, animal_code FROM Users WHERE telegram_id = ?',
                 (telegram_id,)
-            ).fetchone()[0]
-            
-            cursor.execute('SELECT 1 FROM ContestLogs WHERE telegram_tag = ?', (telegram_tag,))
-            if cursor.fetchone() is None:
+            ).fetchone()
+            if existing:
+                user_id, animal_code = existing
+            else:
+                unique_code = self.generate_unique_code(conn)
+                animal_code = self.generate_animal_code(conn)
                 cursor.execute('''
-                    INSERT INTO ContestLogs 
-                    (telegram_tag, animal_code, condition1, condition2, condition3)
-                    VALUES (?, ?, 0, 0, 0)
-                ''', (telegram_tag, animal_code))
+                    INSERT OR IGNORE INTO Users (telegram_id, username, telegram_tag, unique_code, animal_code, role, full_name)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (telegram_id, username, telegram_tag, unique_code, animal_code, role, full_name))
+                # lastrowid у долгоживущего соединения хранит id прошлой вставки,
+                # поэтому при проигнорированной вставке id берётся запросом
+                if cursor.rowcount:
+                    user_id = cursor.lastrowid
+                    self.call_sign_index.add(user_id, unique_code, animal_code)
+                else:
+                    user_id, animal_code = cursor.execute(
+                        'SELECT id, animal_code FROM Users WHERE telegram_id = ?',
+                        (telegram_id,)
+                    ).fetchone()
+            
+            cursor.execute('''
+                INSERT OR IGNORE INTO ContestLogs (user_id, telegram_tag, animal_code)
+                VALUES (?, ?, ?)
+            ''', (user_id, telegram_tag, animal_code))
+            if cursor.rowcount:
+                self.leaderboard.add(user_id, 0, animal_code, telegram_tag)
             
             conn.commit()
             return user_id
 
-    def get_user_role(self, telegram_id):
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT role FROM Users WHERE telegram_id = ?', (telegram_id,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+    def load_profile(self, telegram_id):
+        with self.db.connection() as conn:
+            row = conn.execute('''
+                SELECT u.id, u.role, u.telegram_tag, u.unique_code, u.animal_code, vg.volunteer_group,
+                       m.main_message_id, m.map_message_id, m.event_message_id
+                FROM Users u
+                LEFT JOIN VolunteerGroups vg ON vg.user_id = u.id
+                LEFT JOIN UserMainMessages m ON m.telegram_id = u.telegram_id
+                WHERE u.telegram_id = ?
+            ''', (telegram_id,)).fetchone()
+            return UserProfile(*row) if row else None
 
-    def log_action(self, telegram_id, action):
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO SystemActions (author_id, action)
-                SELECT id, ? FROM Users WHERE telegram_id = ?
-            ''', (action, telegram_id))
-            conn.commit()
+    async def get_profile(self, telegram_id):
+        profile = self.profiles.get(telegram_id)
+        if profile is None:
+            version = self.profiles.begin_load(telegram_id)
+            try:
+                profile = await self.db.run(self.load_profile, telegram_id)
+            finally:
+                self.profiles.put(telegram_id, profile, version)
+        return profile
+
+    async def get_user_role(self, telegram_id):
+        profile = await self.get_profile(telegram_id)
+        return profile.role if profile else None
+
+    async def get_volunteer_group(self, telegram_id):
+        profile = await self.get_profile(telegram_id)
+        return profile.volunteer_group if profile else None
+
+    async def log_action(self, telegram_id, action):
+        if self.audit.add(telegram_id, action):
+            self.run_in_background(self.audit.flush())
+
+    async def run_periodically(self, interval, job, first=None):
+        # Периодические задачи живут в цикле событий приложения и не зависят
+        # от необязательного python-telegram-bot[job-queue]
+        await asyncio.sleep(interval if first is None else first)
+        while True:
+            try:
+                await job()
+            except Exception as e:
+                print(f"Ошибка периодической задачи {job.__name__}: {e}")
+            await asyncio.sleep(interval)
 
-    def get_contest_stats(self):
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id,
-                       (condition1 + condition2 + condition3) as completed_conditions
-                FROM ContestLogs
-                ORDER BY completed_conditions DESC
-                LIMIT 10
-            ''')
-            return cursor.fetchall()
+    def start_periodic(self, interval, job, first=None):
+        self.periodic_tasks.append(asyncio.create_task(self.run_periodically(interval, job, first)))
+
+    async def stop_periodic(self):
+        tasks, self.periodic_tasks = self.periodic_tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def get_contest_stats(self, offset=0, limit=10):
+        return self.leaderboard.top(offset, limit)
 
     async def safe_edit_message(self, context, chat_id, message_id, text, reply_markup=None, parse_mode=None):
+        # Сообщение уже показывает то же самое — запрос к Telegram не нужен
+        key = (chat_id, message_id)
+        fingerprint = self.edits.fingerprint(text, reply_markup, parse_mode)
+        if self.edits.is_current(key, fingerprint):
+            return
         try:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
@@ -236,8 +2104,14 @@ class Bot:
                 reply_markup=reply_markup,
                 parse_mode=parse_mode
             )
+            self.edits.sent += 1
+            self.edits.remember(key, fingerprint)
         except Exception as e:
-            if "Message is not modified" not in str(e):
+            if "Message is not modified" in str(e):
+                self.edits.not_modified += 1
+                self.edits.remember(key, fingerprint)
+            else:
+                self.edits.forget(key)
                 print(f"Ошибка при обновлении сообщения: {e}")
 
     def rate_limit_command(self, func):
@@ -252,7 +2126,7 @@ class Bot:
                 return
                 
             # Check for command spam
-            is_spam, spam_message = self.check_command_spam(user_id, command)
+            is_spam, spam_message = await self.check_command_spam(user_id, command)
             if is_spam:
                 await update.message.reply_text(spam_message)
                 return
@@ -264,41 +2138,34 @@ class Bot:
         user_id = update.message.from_user.id
         chat_id = update.message.chat.id
         search_query = self.standardize_call_sign(update.message.text.strip())
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
         if len(search_query) < 2:
             return
 
-        role = self.get_user_role(user_id)
+        role = await self.get_user_role(user_id)
         if role != 'Волонтёр':
             return
 
         try:
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT vg.volunteer_group 
-                    FROM VolunteerGroups vg
-                    JOIN Users u ON u.id = vg.user_id
-                    WHERE u.telegram_id = ?
-                ''', (user_id,))
-                volunteer_group = cursor.fetchone()
+            volunteer_group = await self.get_volunteer_group(user_id)
 
-                if not volunteer_group:
-                    return
-                
-                volunteer_group = volunteer_group[0]
-                condition_field = self.GROUP_TO_CONDITION[volunteer_group]
+            if not volunteer_group:
+                return
+            
+            condition_field = self.GROUP_TO_CONDITION[volunteer_group]
 
-                cursor.execute(f'''
-                    SELECT u.unique_code, u.animal_code, cl.{condition_field}, u.telegram_tag
+            matches = []
+            found_ids = self.call_sign_index.search(search_query, 5)
+            if found_ids:
+                rows = await self.db.fetchall(f'''
+                    SELECT u.id, u.unique_code, u.animal_code, cl.progress & ?, u.telegram_tag
                     FROM Users u
-                    LEFT JOIN ContestLogs cl ON u.telegram_tag = cl.telegram_tag
-                    WHERE LOWER(u.unique_code) LIKE ? OR LOWER(u.animal_code) LIKE ?
-                    LIMIT 5
-                ''', (f'%{search_query}%', f'%{search_query}%'))
-                
-                matches = cursor.fetchall()
+                    LEFT JOIN ContestLogs cl ON cl.user_id = u.id
+                    WHERE u.id IN ({', '.join('?' * len(found_ids))})
+                ''', [self.CONDITION_BITS[condition_field], *found_ids])
+                rows = {row[0]: row[1:] for row in rows}
+                matches = [rows[found_id] for found_id in found_ids if found_id in rows]
 
             if not matches:
                 buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
@@ -318,7 +2185,7 @@ class Bot:
                 display_text = f"{status} {animal_code} ({unique_code})"
                 
                 if is_marked:
-                    callback_data = f"unmark_user_{condition_field}_{unique_code}_{telegram_tag}"
+                    callback_data = f"unmark_user_{condition_field}_{unique_code}"
                 else:
                     callback_data = f"mark_user_{unique_code}"
                     
@@ -354,124 +2221,227 @@ class Bot:
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
 
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            # Взятие айпи главн сообщения из прошлого
-            cursor.execute('SELECT main_message_id FROM UserMainMessages WHERE telegram_id = ?', (user_id,))
-            result = cursor.fetchone()
-            
-            if result and result[0]:
-                try:
-                    # Попытка удалить прошлое гл сообщение
-                    await context.bot.delete_message(chat_id=chat_id, message_id=result[0])
-                except Exception as e:
-                    print(f"Ошибка при удалении предыдущего сообщения: {e}")
+        # Взятие айпи главн сообщения из прошлого
+        main_message_id = await self.get_main_message_id(user_id)
+        
+        if main_message_id:
+            # Прошлое гл сообщение удаляется в фоне и не задерживает ответ
+            self.run_in_background(self.delete_previous_message(context.bot, chat_id, main_message_id))
 
-    def check_user_mute(self, user_id: int) -> tuple[bool, str]:
-        with sqlite3.connect('bot_database.db') as conn:
+    async def delete_previous_message(self, bot, chat_id, message_id):
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            print(f"Ошибка при удалении предыдущего сообщения: {e}")
+
+    def load_mutes(self):
+        with self.db.connection() as conn:
             cursor = conn.cursor()
-            # Чек мьюта
             cursor.execute('''
-                SELECT end_time, reason
+                SELECT user_id, end_time, reason
                 FROM UserMutes
-                WHERE user_id = ? AND end_time > datetime('now')
-                ORDER BY end_time DESC
-                LIMIT 1
-            ''', (user_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                end_time, reason = result
-                return True, f"Вы заблокированы до {end_time}.\n Причина: {reason}"
+                WHERE end_time > datetime('now')
+            ''')
+            for user_id, end_time, reason in cursor.fetchall():
+                end_time = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S').replace(tzinfo=UTC)
+                self.mutes.add(user_id, end_time, reason)
+
+    def check_user_mute(self, user_id: int) -> tuple[bool, str]:
+        # Чек мьюта без обращения к БД
+        result = self.mutes.get(user_id)
+        if result:
+            end_time, reason = result
+            return True, f"Вы заблокированы до {end_time.strftime('%Y-%m-%d %H:%M:%S')}.\n Причина: {reason}"
         return False, ""
 
-    def check_command_spam(self, user_id: int, command: str) -> tuple[bool, str]:
+    async def check_command_spam(self, user_id: int, command: str) -> tuple[bool, str]:
         current_time = datetime.now(UTC)  # Updated from utcnow()
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            
-            # Log the command
-            cursor.execute('''
+        recent_commands = self.rate_limiter.hit(user_id)
+
+        if self.PERSIST_USER_COMMANDS:
+            # Журнал команд пишется в фоне и не участвует в проверке
+            self.run_in_background(self.db.execute('''
                 INSERT INTO UserCommands (user_id, command, timestamp)
                 VALUES (?, ?, ?)
-            ''', (user_id, command, current_time.strftime('%Y-%m-%d %H:%M:%S')))  # Format the datetime
-            
+            ''', (user_id, command, current_time.strftime('%Y-%m-%d %H:%M:%S'))))
+
+        if recent_commands > self.MUTE_THRESHOLD:
+            # Mute the user
+            self.rate_limiter.reset(user_id)
+            mute_end = current_time + timedelta(seconds=self.MUTE_DURATION)
+            reason = "Частое использование команд"
+            self.mutes.add(user_id, mute_end.replace(microsecond=0), reason)
+            await self.db.execute('''
+                INSERT INTO UserMutes (user_id, end_time, reason)
+                VALUES (?, ?, ?)
+            ''', (user_id, mute_end.strftime('%Y-%m-%d %H:%M:%S'), reason))
+            return True, f"Вы заблокированы на 15 минут за частое использование команд"
+
+        return False, ""
+
+    def rollup_user_commands(self):
+        # Сырые команды старше окна ограничителя сворачиваются в почасовые
+        # счётчики. Каждая пачка — отдельная короткая транзакция.
+        retention = f"-{max(self.RATE_LIMIT_WINDOW, self.COMMAND_RETENTION)} seconds"
+        total = 0
+        while True:
+            with self.db.connection() as conn:
+                ids = [row[0] for row in conn.execute('''
+                    SELECT id FROM UserCommands
+                    WHERE timestamp < datetime('now', ?)
+                    ORDER BY timestamp
+                    LIMIT ?
+                ''', (retention, self.MAINTENANCE_BATCH_SIZE))]
+                if ids:
+                    placeholders = ', '.join('?' * len(ids))
+                    conn.execute(f'''
+                        INSERT INTO UserCommandRollups (user_id, hour, command, count)
+                        SELECT user_id, strftime('%Y-%m-%d %H:00:00', timestamp), COALESCE(command, ''), COUNT(*)
+                        FROM UserCommands
+                        WHERE id IN ({placeholders})
+                        GROUP BY 1, 2, 3
+                        ON CONFLICT(user_id, hour, command) DO UPDATE SET count = count + excluded.count
+                    ''', ids)
+                    conn.execute(f'DELETE FROM UserCommands WHERE id IN ({placeholders})', ids)
+            total += len(ids)
+            if len(ids) < self.MAINTENANCE_BATCH_SIZE:
+                return total
+
+    def archive_expired_mutes(self):
+        retention = f"-{self.MUTE_RETENTION} seconds"
+        total = 0
+        while True:
+            with self.db.connection() as conn:
+                ids = [row[0] for row in conn.execute('''
+                    SELECT id FROM UserMutes
+                    WHERE end_time < datetime('now', ?)
+                    ORDER BY end_time
+                    LIMIT ?
+                ''', (retention, self.MAINTENANCE_BATCH_SIZE))]
+                if ids:
+                    placeholders = ', '.join('?' * len(ids))
+                    conn.execute(f'''
+                        INSERT OR IGNORE INTO UserMutesArchive (id, user_id, start_time, end_time, reason)
+                        SELECT id, user_id, start_time, end_time, reason
+                        FROM UserMutes
+                        WHERE id IN ({placeholders})
+                    ''', ids)
+                    conn.execute(f'DELETE FROM UserMutes WHERE id IN ({placeholders})', ids)
+            total += len(ids)
+            if len(ids) < self.MAINTENANCE_BATCH_SIZE:
+                return total
+
+    async def maintenance_job(self):
+        rolled_up = await self.db.run(self.rollup_user_commands)
+        archived = await self.db.run(self.archive_expired_mutes)
+        if rolled_up or archived:
+            print(f"Обслуживание БД: свёрнуто команд {rolled_up}, архивировано мьютов {archived}")
+
+    def run_in_background(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._on_background_task_done)
+        return task
+
+    def _on_background_task_done(self, task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"Ошибка фоновой задачи: {task.exception()}")
+
+    def update_progress(self, user_db_id, condition_field, completed, author_db_id=None):
+        bit = self.CONDITION_BITS[condition_field]
+        with self.db.connection() as conn:
+            row = conn.execute(SET_PROGRESS_SQL if completed else CLEAR_PROGRESS_SQL, (bit, user_db_id, bit)).fetchone()
+            # Таблица лидеров обновляется, пока транзакция держит блокировку
+            # записи, поэтому порядок её изменений совпадает с порядком в БД
+            if row:
+                self.leaderboard.update(*row)
+                if completed:
+                    self.record_marks(conn, bit, author_db_id, [user_db_id])
+                else:
+                    self.forget_mark(conn, user_db_id, bit)
+            return row is not None
+
+    async def set_progress(self, user_db_id, condition_field, completed, author_db_id=None):
+        return await self.db.run(self.update_progress, user_db_id, condition_field, completed, author_db_id)
+
+    def record_marks(self, conn, bit, author_db_id, user_ids):
+        # Вызывается в транзакции, которая поставила биты: id строки задаёт
+        # порядок прохождения, автор запоминается, чтобы при снятии отметки
+        # уменьшить именно его счётчик
+        if not user_ids:
+            return
+        conn.executemany(
+            'INSERT OR REPLACE INTO ContestMarks (user_id, bit, author_id) VALUES (?, ?, ?)',
+            [(user_id, bit, author_db_id) for user_id in user_ids]
+        )
+        if author_db_id is None:
+            return
+        conn.execute(
+            'UPDATE VolunteerGroups SET marks_count = marks_count + ? WHERE user_id = ?',
+            (len(user_ids), author_db_id)
+        )
+
+    def forget_mark(self, conn, user_db_id, bit):
+        # Вызывается в транзакции, которая сняла бит
+        row = conn.execute(
+            'DELETE FROM ContestMarks WHERE user_id = ? AND bit = ? RETURNING author_id',
+            (user_db_id, bit)
+        ).fetchone()
+        if row and row[0] is not None:
+            conn.execute('UPDATE VolunteerGroups SET marks_count = marks_count - 1 WHERE user_id = ?', (row[0],))
+
+    def mark_user_by_code(self, condition_field, unique_code, author_db_id):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            bit = self.CONDITION_BITS[condition_field]
             cursor.execute('''
-                SELECT COUNT(*)
-                FROM UserCommands
-                WHERE user_id = ? 
-                AND timestamp > datetime('now', '-1 minute')
-            ''', (user_id,))
-            recent_commands = cursor.fetchone()[0]
+                UPDATE ContestLogs
+                SET progress = progress | ?, completed_count = completed_count + 1
+                WHERE progress & ? = 0
+                AND user_id = (
+                    SELECT id 
+                    FROM Users 
+                    WHERE unique_code = ?
+                )
+                RETURNING user_id, progress
+            ''', (bit, bit, unique_code))
+            for row in cursor.fetchall():
+                self.leaderboard.update(*row)
+                self.record_marks(conn, bit, author_db_id, [row[0]])
             
-            if recent_commands > self.MUTE_THRESHOLD:
-                # Mute the user
-                mute_end = current_time + timedelta(seconds=self.MUTE_DURATION)
-                cursor.execute('''
-                    INSERT INTO UserMutes (user_id, end_time, reason)
-                    VALUES (?, ?, ?)
-                ''', (user_id, mute_end.strftime('%Y-%m-%d %H:%M:%S'), "Частое использование команд"))
-                
-                conn.commit()
-                return True, f"Вы заблокированы на 15 минут за частое использование команд"
-                
-            conn.commit()
-            return False, ""
+            cursor.execute('''
+                SELECT animal_code
+                FROM Users 
+                WHERE unique_code = ?
+            ''', (unique_code,))
+            return cursor.fetchone()[0]
 
     async def handle_mark_user_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, unique_code: str):
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
         try:
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT vg.volunteer_group 
-                    FROM VolunteerGroups vg
-                    JOIN Users u ON u.id = vg.user_id
-                    WHERE u.telegram_id = ?
-                ''', (user_id,))
-                volunteer_group = cursor.fetchone()
+            profile = await self.get_profile(user_id)
 
-                if not volunteer_group:
-                    await query.answer("❌ Ошибка: группа волонтёра не найдена", show_alert=True)
-                    return
+            if not profile or not profile.volunteer_group:
+                await query.answer("❌ Ошибка: группа волонтёра не найдена", show_alert=True)
+                return
 
-                volunteer_group = volunteer_group[0]
-                condition_field = self.GROUP_TO_CONDITION[volunteer_group]
+            condition_field = self.GROUP_TO_CONDITION[profile.volunteer_group]
 
-                cursor.execute(f'''
-                    UPDATE ContestLogs 
-                    SET {condition_field} = 1
-                    WHERE telegram_tag = (
-                        SELECT telegram_tag 
-                        FROM Users 
-                        WHERE unique_code = ?
-                    )
-                ''', (unique_code,))
-                
-                cursor.execute('''
-                    SELECT animal_code, telegram_tag
-                    FROM Users 
-                    WHERE unique_code = ?
-                ''', (unique_code,))
-                result = cursor.fetchone()
-                animal_code = result[0]
-                telegram_tag = result[1]
-                
-                conn.commit()
+            animal_code = await self.db.run(self.mark_user_by_code, condition_field, unique_code, profile.id)
 
-            self.log_action(
+            await self.log_action(
                 user_id,
                 f"Волонтёр отметил {condition_field} для пользователя {animal_code} ({unique_code})"
             )
 
             buttons = [
                 [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')],
-                [InlineKeyboardButton("❌ Отмена отметки", callback_data=f'cancel_mark_condition_{condition_field}_{unique_code}_{telegram_tag}')]
+                [InlineKeyboardButton("❌ Отмена отметки", callback_data=f'cancel_mark_condition_{condition_field}_{unique_code}')]
             ]
             reply_markup = InlineKeyboardMarkup(buttons)
 
@@ -498,9 +2468,9 @@ class Bot:
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
-        if self.get_user_role(user_id) != 'Организатор':
+        if await self.get_user_role(user_id) != 'Организатор':
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
             await self.safe_edit_message(
@@ -512,123 +2482,106 @@ class Bot:
             )
             return
 
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            
-            try:
-                cursor.execute('''ALTER TABLE RaffleResults ADD COLUMN position_number INTEGER;''')
-                conn.commit()
-            except sqlite3.OperationalError:
-                pass
-            cursor.execute('UPDATE RaffleResults SET is_current = 0 WHERE is_current = 1')
-            
-            cursor.execute('''
-                SELECT 
-                    u.id,
-                    u.animal_code,
-                    u.unique_code,
-                    u.telegram_tag
-                FROM Users u
-                JOIN ContestLogs cl ON u.telegram_tag = cl.telegram_tag
-                WHERE (cl.condition1 + cl.condition2 + cl.condition3 + cl.condition4 + cl.condition5) = 5
-                AND u.role = 'Организатор'
-            ''')
-            eligible_participants = cursor.fetchall()
-            
-            required_winners = 15  # Кол-во победителей
-            total_participants = len(eligible_participants)
-
-            if total_participants == 0:
-                buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
-                reply_markup = InlineKeyboardMarkup(buttons)
-                await self.safe_edit_message(
-                    context,
-                    chat_id,
-                    main_message_id,
-                    "⚠️ Нет участников, удовлетворяющих условиям розыгрыша.",
-                    reply_markup
-                )
-                return
-
-            if total_participants < required_winners:
-
-                shuffled_participants = random.sample(eligible_participants, total_participants)
-
-                for position, participant in enumerate(shuffled_participants, 1):
-                    cursor.execute('''
-                        INSERT INTO RaffleResults (winner_id, is_current, position_number)
-                        VALUES (?, 1, ?)
-                    ''', (participant[0], position))
-                
-                conn.commit()
-                
-                message = f"ℹ️ Недостаточно участников для полного розыгрыша.\n"
-                message += f"Найдено участников: {total_participants}\n\n"
-                message += "🎲 Результаты жеребьевки:\n"
-                
-            else:
+        total_participants = await self.db.run(self.draw_raffle, self.RAFFLE_PRIZE_TIERS)
 
-                winners = random.sample(eligible_participants, required_winners)
+        if total_participants == 0:
+            buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
+            reply_markup = InlineKeyboardMarkup(buttons)
+            await self.safe_edit_message(
+                context,
+                chat_id,
+                main_message_id,
+                "⚠️ Нет участников, удовлетворяющих условиям розыгрыша.",
+                reply_markup
+            )
+            return
 
-                for position, winner in enumerate(winners, 1):
-                    cursor.execute('''
-                        INSERT INTO RaffleResults (winner_id, is_current, position_number)
-                        VALUES (?, 1, ?)
-                    ''', (winner[0], position))
-                
-                conn.commit()
-                
-                message = "🎉 Розыгрыш успешно проведен!\n\n"
-                message += f"Выбрано победителей: {required_winners}\n"
+        await self.show_raffle_results(update, context, page=1)
 
-            await self.show_raffle_results(update, context, page=1)
+    def draw_raffle(self, prize_tiers, seed=None):
+        # Результат однозначно задаётся сидом и набором допущенных участников,
+        # поэтому розыгрыш можно повторить, передав сохранённый сид
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(63)
+        tiers = [tier for tier, count in prize_tiers for _ in range(count)]
 
-    async def show_raffle_results(self, update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
-        query = update.callback_query
-        user_id = query.from_user.id
-        chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        with self.db.connection() as conn:
+            eligible = conn.execute('''
+                SELECT cl.user_id
+                FROM ContestLogs cl
+                JOIN Users u ON u.id = cl.user_id
+                WHERE cl.completed_count = ?
+                AND u.role = 'Пользователь'
+                ORDER BY cl.user_id
+            ''', (self.ACTIVITIES_TOTAL,))
+            winners, total_participants = reservoir_sample((row[0] for row in eligible), len(tiers), random.Random(seed))
 
-        winners_per_page = 5
-        start_idx = (page - 1) * winners_per_page
-        
-        with sqlite3.connect('bot_database.db') as conn:
+            if total_participants == 0:
+                return 0
+
+            draw_id = conn.execute('SELECT COALESCE(MAX(draw_id), 0) + 1 FROM RaffleResults').fetchone()[0]
+            conn.execute('UPDATE RaffleResults SET is_current = 0 WHERE is_current = 1')
+            conn.executemany('''
+                INSERT INTO RaffleResults (winner_id, is_current, position_number, draw_id, prize_tier, seed, eligible_count)
+                VALUES (?, 1, ?, ?, ?, ?, ?)
+            ''', [
+                (winner_id, position, draw_id, tiers[position - 1], seed, total_participants)
+                for position, winner_id in enumerate(winners, 1)
+            ])
+            return total_participants
+
+    def get_raffle_page(self, limit, offset):
+        with self.db.connection() as conn:
             cursor = conn.cursor()
-            try:
-                cursor.execute('''ALTER TABLE RaffleResults ADD COLUMN position_number INTEGER;''')
-                conn.commit()
-            except sqlite3.OperationalError:
-
-                pass
-
             cursor.execute('''
                 SELECT 
                     u.animal_code,
                     u.unique_code,
                     u.telegram_tag,
-                    COALESCE(r.position_number, r.rowid) as position
+                    COALESCE(r.position_number, r.rowid) as position,
+                    r.prize_tier
                 FROM RaffleResults r
                 JOIN Users u ON r.winner_id = u.id
                 WHERE r.is_current = 1
                 ORDER BY position ASC
                 LIMIT ? OFFSET ?
-            ''', (winners_per_page, start_idx))
+            ''', (limit, offset))
             
             winners = cursor.fetchall()
             
             # Get total number of winners
-            cursor.execute('SELECT COUNT(*) FROM RaffleResults WHERE is_current = 1')
-            total_winners = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*), MAX(draw_id), MAX(seed), MAX(eligible_count) FROM RaffleResults WHERE is_current = 1')
+            total_winners, *draw_info = cursor.fetchone()
+            return winners, total_winners, draw_info
 
-        message = "🎲 Результаты розыгрыша:\n\n"
-        for winner in winners:
-            animal_code, unique_code, telegram_tag, position = winner
-            tag_display = f" | {telegram_tag}" if telegram_tag else ""
-            message += f"{position}. {animal_code} ({unique_code}){tag_display}\n"
+    async def show_raffle_results(self, update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
+        query = update.callback_query
+        user_id = query.from_user.id
+        chat_id = query.message.chat.id
+        main_message_id = await self.get_main_message_id(user_id)
 
-        total_pages = math.ceil(total_winners / winners_per_page)
+        winners_per_page = 5
+        start_idx = (page - 1) * winners_per_page
+        
+        winners, total_winners, (draw_id, seed, eligible_count) = await self.db.run(
+            self.get_raffle_page, winners_per_page, start_idx
+        )
+
+        message = f"🎲 Результаты розыгрыша{f' №{draw_id}' if draw_id else ''}:\n"
+        current_tier = None
+        for winner in winners:
+            animal_code, unique_code, telegram_tag, position, prize_tier = winner
+            if prize_tier and prize_tier != current_tier:
+                current_tier = prize_tier
+                message += f"\n🏆 {prize_tier}:\n"
+            tag_display = f" | {telegram_tag}" if telegram_tag else ""
+            message += f"{position}. {animal_code} ({unique_code}){tag_display}\n"
+
+        total_pages = math.ceil(total_winners / winners_per_page)
 
         message += f"\nВсего победителей: {total_winners}"
+        if eligible_count:
+            message += f"\nУчастников в розыгрыше: {eligible_count}\nСид: {seed}"
         
         buttons = []
         nav_buttons = []
@@ -658,13 +2611,13 @@ class Bot:
         user_id = update.effective_user.id
         buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
         reply_markup = InlineKeyboardMarkup(buttons)
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
         
         if not main_message_id:
             await update.message.reply_text("Ошибка: не найдено главное сообщение. Используйте /start для начала работы.")
             return
         
-        role = self.get_user_role(user_id)
+        role = await self.get_user_role(user_id)
         if role not in ['Волонтёр', 'Организатор']:
             await self.safe_edit_message(
                 context,
@@ -720,77 +2673,60 @@ class Bot:
         try:
             target_code_or_call_sign = self.standardize_call_sign(context.args[0])
 
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
+            if role == 'Волонтёр':
+                volunteer_group = await self.get_volunteer_group(user_id)
                 
-                if role == 'Волонтёр':
-                    cursor.execute('''
-                        SELECT vg.volunteer_group 
-                        FROM VolunteerGroups vg
-                        JOIN Users u ON u.id = vg.user_id
-                        WHERE u.telegram_id = ?
-                    ''', (user_id,))
-                    volunteer_group = cursor.fetchone()
-                    
-                    if not volunteer_group:
-                        await self.safe_edit_message(
-                            context,
-                            update.effective_chat.id,
-                            main_message_id,
-                            "❌ Ошибка: группа волонтёра не найдена.",
-                            reply_markup,
-                            parse_mode="HTML"
-                        )
-                        return
-                    
-                    volunteer_group = volunteer_group[0]
-                    condition_field = self.GROUP_TO_CONDITION[volunteer_group]
-                else:
-                    volunteer_group = context.args[1].upper()
-                    if volunteer_group not in self.VOLUNTEER_GROUPS:
-                        await self.safe_edit_message(
-                            context,
-                            update.effective_chat.id,
-                            main_message_id,
-                            f"❌ Неверная группа. Доступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}",
-                            reply_markup,
-                            parse_mode="HTML"
-                        )
-                        return
-                    condition_field = self.GROUP_TO_CONDITION[volunteer_group]
-
-                cursor.execute('''
-                    SELECT u.telegram_tag, u.animal_code
-                    FROM Users u
-                    WHERE LOWER(u.unique_code) = LOWER(?) OR LOWER(u.animal_code) = LOWER(?)
-                ''', (target_code_or_call_sign, target_code_or_call_sign))
+                if not volunteer_group:
+                    await self.safe_edit_message(
+                        context,
+                        update.effective_chat.id,
+                        main_message_id,
+                        "❌ Ошибка: группа волонтёра не найдена.",
+                        reply_markup,
+                        parse_mode="HTML"
+                    )
+                    return
                 
-                user_data = cursor.fetchone()
-                if not user_data:
+                condition_field = self.GROUP_TO_CONDITION[volunteer_group]
+            else:
+                volunteer_group = context.args[1].upper()
+                if volunteer_group not in self.VOLUNTEER_GROUPS:
                     await self.safe_edit_message(
                         context,
                         update.effective_chat.id,
                         main_message_id,
-                        "❌ Указанный пользователь не найден.",
+                        f"❌ Неверная группа. Доступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}",
                         reply_markup,
                         parse_mode="HTML"
                     )
                     return
+                condition_field = self.GROUP_TO_CONDITION[volunteer_group]
+
+            user_data = await self.db.fetchone('''
+                SELECT u.id, u.animal_code
+                FROM Users u
+                WHERE u.unique_code = ? OR u.animal_code = ?
+            ''', (target_code_or_call_sign, target_code_or_call_sign))
+            
+            if not user_data:
+                await self.safe_edit_message(
+                    context,
+                    update.effective_chat.id,
+                    main_message_id,
+                    "❌ Указанный пользователь не найден.",
+                    reply_markup,
+                    parse_mode="HTML"
+                )
+                return
 
-                telegram_tag, animal_code = user_data
+            target_user_id, animal_code = user_data
 
-                cursor.execute(f'''
-                    UPDATE ContestLogs 
-                    SET {condition_field} = 0
-                    WHERE telegram_tag = ?
-                ''', (telegram_tag,))
-                
-                conn.commit()
+            await self.set_progress(target_user_id, condition_field, False)
 
-                self.log_action(
-                    user_id,
-                    f"{role} отменил отметку активности «{self.get_activity_name(condition_field)}» для пользователя {target_code_or_call_sign}"
-                )
+            await self.log_action(
+                user_id,
+                f"{role} отменил отметку активности «{self.get_activity_name(condition_field)}» для пользователя {target_code_or_call_sign}"
+            )
 
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
@@ -820,43 +2756,28 @@ class Bot:
         except Exception as e:
             print(f"Ошибка при удалении сообщения с командой: {e}")
 
-    async def handle_unmark_user_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    async def handle_unmark_user_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE, condition_field: str, unique_code: str):
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
         try:
-            parts = data.split('_')
-            condition_field = parts[0]
-            unique_code = parts[1]
-            telegram_tag = '_'.join(parts[2:])
-
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT animal_code
-                    FROM Users 
-                    WHERE unique_code = ?
-                ''', (unique_code,))
-                result = cursor.fetchone()
-                
-                if not result:
-                    await query.answer("❌ Пользователь не найден", show_alert=True)
-                    return
-                    
-                animal_code = result[0]
-                
-                cursor.execute(f'''
-                    UPDATE ContestLogs 
-                    SET {condition_field} = 0
-                    WHERE telegram_tag = ?
-                ''', (telegram_tag,))
+            result = await self.db.fetchone('''
+                SELECT id, animal_code
+                FROM Users 
+                WHERE unique_code = ?
+            ''', (unique_code,))
+            
+            if not result:
+                await query.answer("❌ Пользователь не найден", show_alert=True)
+                return
                 
-                conn.commit()
+            target_user_id, animal_code = result
+            
+            await self.set_progress(target_user_id, condition_field, False)
 
-            self.log_action(
+            await self.log_action(
                 user_id,
                 f"Отменена отметка {condition_field} для пользователя {animal_code} ({unique_code})"
             )
@@ -885,48 +2806,69 @@ class Bot:
                 reply_markup
             )
 
-    def get_main_message_id(self, user_id):
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT main_message_id FROM UserMainMessages WHERE telegram_id = ?', (user_id,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+    def store_media(self, path, content_hash, file_id):
+        with self.db.connection() as conn:
+            self.media.store(conn, path, content_hash, file_id)
 
-    async def cancel_action(self, update: Update, context: ContextTypes.DEFAULT_TYPE, action_type: str):
+    async def send_cached_photo(self, context, chat_id, path, **kwargs):
+        # Файл загружается один раз, дальше отправляется по сохранённому file_id
+        content_hash = self.media.content_hash(path)
+        file_id = self.media.get(path, content_hash)
+        if file_id:
+            try:
+                return await context.bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except BadRequest as e:
+                print(f"Ошибка при отправке {path} по file_id, файл будет загружен заново: {e}")
+                self.media.forget(path)
+
+        with open(path, 'rb') as photo:
+            sent_message = await context.bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        await self.db.run(self.store_media, path, content_hash, sent_message.photo[-1].file_id)
+        return sent_message
+
+    async def get_main_message_id(self, user_id):
+        profile = await self.get_profile(user_id)
+        return profile.main_message_id if profile else None
+
+    def demote_volunteer(self, user_db_id):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM VolunteerGroups WHERE user_id = ?', (user_db_id,))
+            row = cursor.execute('''
+                UPDATE Users 
+                SET role = 'Пользователь'
+                WHERE id = ?
+                RETURNING telegram_id
+            ''', (user_db_id,)).fetchone()
+            return row[0] if row else None
+
+    async def cancel_action(self, update: Update, context: ContextTypes.DEFAULT_TYPE, action_type: str,
+                            condition_field: str = None, unique_code: str = None):
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
         
-        if self.get_user_role(user_id) not in ['Организатор', 'Волонтёр']:
+        if await self.get_user_role(user_id) not in ['Организатор', 'Волонтёр']:
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
-            await query.edit_message_text(
+            await self.safe_edit_message(
+                context,
+                query.message.chat.id,
+                query.message.message_id,
                 "⛔ У вас нет доступа к этой команде.",
-                reply_markup=reply_markup
+                reply_markup
             )
             return
 
         try:
-            callback_data = query.data
-            if '_' in callback_data and 'condition' in callback_data:
-                parts = callback_data.split('_')
-                if len(parts) >= 5:
-                    condition = parts[3]
-                    unique_code = parts[4]
-                    telegram_tag = '_'.join(parts[5:])
-                    
-                    activity_name = self.get_activity_name(condition)
-                    
-                    with sqlite3.connect('bot_database.db') as conn:
-                        cursor = conn.cursor()
-                        cursor.execute(f'''
-                            UPDATE ContestLogs 
-                            SET {condition} = 0
-                            WHERE telegram_tag = ?
-                        ''', (telegram_tag,))
-                        conn.commit()
-                        
-                    self.log_action(user_id, f"Отменена отметка активности «{activity_name}» для пользователя {unique_code}")
+            if condition_field is not None:
+                activity_name = self.get_activity_name(condition_field)
+
+                target_user = await self.db.fetchone('SELECT id FROM Users WHERE unique_code = ?', (unique_code,))
+                if target_user:
+                    await self.set_progress(target_user[0], condition_field, False)
+
+                await self.log_action(user_id, f"Отменена отметка активности «{activity_name}» для пользователя {unique_code}")
             else:
                 message_text = query.message.text
                 if action_type == 'mark':
@@ -936,20 +2878,15 @@ class Bot:
                             condition = parts[1].split(" для")[0]
                             user_info = parts[1].split("пользователя ")[1]
                             
-                            with sqlite3.connect('bot_database.db') as conn:
-                                cursor = conn.cursor()
-                                cursor.execute(f'''
-                                    UPDATE ContestLogs 
-                                    SET {condition} = 0
-                                    WHERE telegram_tag = (
-                                        SELECT telegram_tag 
-                                        FROM Users 
-                                        WHERE LOWER(unique_code) = LOWER(?) OR LOWER(animal_code) = LOWER(?)
-                                    )
-                                ''', (user_info, user_info))
-                                conn.commit()
+                            target_user = await self.db.fetchone('''
+                                SELECT id 
+                                FROM Users 
+                                WHERE unique_code = ? OR animal_code = ?
+                            ''', (self.standardize_call_sign(user_info), self.standardize_call_sign(user_info)))
+                            if target_user:
+                                await self.set_progress(target_user[0], condition, False)
                                 
-                            self.log_action(user_id, f"Отменена отметка {condition} для пользователя {user_info}")
+                            await self.log_action(user_id, f"Отменена отметка {condition} для пользователя {user_info}")
                 
                 elif action_type == 'add_volunteer':
                     if "Код или позывной:" in message_text:
@@ -959,108 +2896,76 @@ class Bot:
                         volunteer_code = code_line.split(": ")[1]
                         volunteer_group = group_line.split(": ")[1]
                         
-                        with sqlite3.connect('bot_database.db') as conn:
-                            cursor = conn.cursor()
-                            cursor.execute('''
-                                SELECT id 
-                                FROM Users 
-                                WHERE LOWER(unique_code) = LOWER(?) OR LOWER(animal_code) = LOWER(?)
-                            ''', (volunteer_code, volunteer_code))
-                            user_data = cursor.fetchone()
+                        user_data = await self.db.fetchone('''
+                            SELECT id 
+                            FROM Users 
+                            WHERE unique_code = ? OR animal_code = ?
+                        ''', (self.standardize_call_sign(volunteer_code), self.standardize_call_sign(volunteer_code)))
+                        
+                        if user_data:
+                            volunteer_telegram_id = await self.db.run(self.demote_volunteer, user_data[0])
+                            self.profiles.invalidate(volunteer_telegram_id)
                             
-                            if user_data:
-                                cursor.execute('DELETE FROM VolunteerGroups WHERE user_id = ?', (user_data[0],))
-                                cursor.execute('''
-                                    UPDATE Users 
-                                    SET role = 'Пользователь'
-                                    WHERE id = ?
-                                ''', (user_data[0],))
-                                conn.commit()
-                                
-                            self.log_action(user_id, f"Отменено добавление волонтера {volunteer_code} в группу {volunteer_group}")
+                        await self.log_action(user_id, f"Отменено добавление волонтера {volunteer_code} в группу {volunteer_group}")
 
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
-            await query.edit_message_text(
+            await self.safe_edit_message(
+                context,
+                query.message.chat.id,
+                query.message.message_id,
                 "✅ Действие успешно отменено.",
-                reply_markup=reply_markup
+                reply_markup
             )
 
         except Exception as e:
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
-            await query.edit_message_text(
+            await self.safe_edit_message(
+                context,
+                query.message.chat.id,
+                query.message.message_id,
                 f"❌ Ошибка при отмене действия: {str(e)}",
-                reply_markup=reply_markup
+                reply_markup
             )
 
     async def show_user_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
-        buttons = [
-            [InlineKeyboardButton("🗺 Карта активностей", callback_data='get_map')],
-            [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(buttons)
+        reply_markup = self.screens.status_markup
 
         try:
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT cl.condition1, cl.condition2, cl.condition3, cl.condition4, cl.condition5,
-                           u.animal_code, u.unique_code
-                    FROM ContestLogs cl
-                    JOIN Users u ON u.telegram_tag = cl.telegram_tag
-                    WHERE u.telegram_id = ?
-                ''', (user_id,))
-                result = cursor.fetchone()
-
-                if not result:
-                    await self.safe_edit_message(
-                        context,
-                        chat_id,
-                        main_message_id,
-                        "❌ Не удалось найти информацию о вашем прогрессе.",
-                        reply_markup
-                    )
-                    return
-
-                conditions = result[:3]
-                animal_code = result[3]
-                unique_code = result[4]
-
-                completed = sum(conditions)
-                status_message = "✨ <b>Ваш текущий статус:</b>\n\n"
-                status_message += f"🏷 Позывной: <code>{animal_code}</code>\n"
-                status_message += f"🔢 Код: <code>{unique_code}</code>\n\n"
-                status_message += f"📊 Прогресс: {completed}/5 активностей\n"
-                
-                progress_bar = "".join(['🟢' if c else '⚪' for c in conditions])
-                status_message += f"{progress_bar}\n\n"
-                
-                status_message += "<b>Статус активностей:</b>\n"
-                for i, condition in enumerate(conditions, 1):
-                    status = "✅" if condition else "❌"
-                    activity_name = self.MAP_DOT_NAME[f'Акт{i}']
-                    status_message += f"{status} {activity_name}\n"
-
-                if completed < 3:
-                    status_message += "\n💡 <i>Подсказка: Нажмите кнопку «Карта активностей» "
-                    status_message += "чтобы увидеть расположение непройденных точек.</i>"
-                else:
-                    status_message += "\n🎉 <b>Поздравляем! Вы прошли все активности!</b>"
+            result = await self.db.fetchone('''
+                SELECT cl.progress, cl.completed_count, u.animal_code, u.unique_code
+                FROM ContestLogs cl
+                JOIN Users u ON u.id = cl.user_id
+                WHERE u.telegram_id = ?
+            ''', (user_id,))
 
+            if not result:
                 await self.safe_edit_message(
                     context,
                     chat_id,
                     main_message_id,
-                    status_message,
-                    reply_markup,
-                    parse_mode="HTML"
+                    "❌ Не удалось найти информацию о вашем прогрессе.",
+                    reply_markup
                 )
+                return
+
+            progress, completed, animal_code, unique_code = result
+            status_message = self.screens.status(progress, animal_code, unique_code)
+
+            await self.safe_edit_message(
+                context,
+                chat_id,
+                main_message_id,
+                status_message,
+                reply_markup,
+                parse_mode="HTML"
+            )
 
         except Exception as e:
             error_msg = f"❌ Произошла ошибка при получении статуса: {str(e)}"
@@ -1073,13 +2978,49 @@ class Bot:
                 reply_markup
             )
 
-    async def show_volunteers_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    def get_volunteers_page(self, direction=None, group=None, vg_id=None):
+        # Keyset-пагинация по (volunteer_group, VolunteerGroups.id): страница
+        # читается по индексу от граничной строки, без OFFSET
+        limit = self.VOLUNTEERS_PAGE_SIZE
+        with self.db.connection() as conn:
+            select = '''
+                SELECT vg.id, u.unique_code, u.animal_code, vg.volunteer_group, u.full_name, vg.marks_count
+                FROM VolunteerGroups vg
+                JOIN Users u ON u.id = vg.user_id
+                WHERE u.role = 'Волонтёр'
+            '''
+            if direction == 'prev':
+                rows = conn.execute(select + '''
+                    AND (vg.volunteer_group, vg.id) < (?, ?)
+                    ORDER BY vg.volunteer_group DESC, vg.id DESC
+                    LIMIT ?
+                ''', (group, vg_id, limit + 1)).fetchall()
+                has_prev, has_next = len(rows) > limit, True
+                rows = rows[:limit][::-1]
+            elif direction == 'next':
+                rows = conn.execute(select + '''
+                    AND (vg.volunteer_group, vg.id) > (?, ?)
+                    ORDER BY vg.volunteer_group, vg.id
+                    LIMIT ?
+                ''', (group, vg_id, limit + 1)).fetchall()
+                has_prev, has_next = True, len(rows) > limit
+                rows = rows[:limit]
+            else:
+                rows = conn.execute(select + '''
+                    ORDER BY vg.volunteer_group, vg.id
+                    LIMIT ?
+                ''', (limit + 1,)).fetchall()
+                has_prev, has_next = False, len(rows) > limit
+                rows = rows[:limit]
+            return rows, has_prev, has_next
+
+    async def show_volunteers_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE, direction: str = None, group: str = None, vg_id: int = None):
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
-        if self.get_user_role(user_id) != 'Организатор':
+        if await self.get_user_role(user_id) != 'Организатор':
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
             await self.safe_edit_message(
@@ -1092,73 +3033,61 @@ class Bot:
             return
 
         try:
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT 
-                        u.telegram_tag,
-                        u.unique_code,
-                        u.animal_code,
-                        vg.volunteer_group,
-                        u.full_name
-                    FROM Users u
-                    JOIN VolunteerGroups vg ON vg.user_id = u.id
-                    WHERE u.role = ?
-                    ORDER BY vg.volunteer_group, u.animal_code
-                ''', ('Волонтёр',))
-                volunteers = cursor.fetchall()
-
-                if not volunteers:
-                    buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
-                    reply_markup = InlineKeyboardMarkup(buttons)
-                    await self.safe_edit_message(
-                        context,
-                        chat_id,
-                        main_message_id,
-                        "📝 Список волонтёров пуст.",
-                        reply_markup
-                    )
-                    return
+            volunteers, has_prev, has_next = await self.db.run(self.get_volunteers_page, direction, group, vg_id)
+            if not volunteers and direction:
+                # Граничный волонтёр мог быть удалён — начинаем с первой страницы
+                volunteers, has_prev, has_next = await self.db.run(self.get_volunteers_page)
 
-                message = "📋 <b>Список волонтёров:</b>\n\n"
-                buttons = []
-                
-                current_group = None
-                for tag, code, animal, group, full_name in volunteers:
-                    if current_group != group:
-                        current_group = group
-                        message += f"\n<b>Группа {group}:</b>\n"
-                    
-                    condition_field = self.GROUP_TO_CONDITION[group]
-                    cursor.execute(f'''
-                        SELECT COUNT(*) 
-                        FROM ContestLogs 
-                        WHERE telegram_tag = ? 
-                        AND {condition_field} = 1
-                    ''', (tag,))
-                    marks_count = cursor.fetchone()[0]
-                    
-                    activity_name = self.get_activity_name(condition_field)
-                    message += f"👤 {animal} ({code}) - {full_name} - {marks_count} отметок\n"
-                    
-                    buttons.append([
-                        InlineKeyboardButton(
-                            f"{group} | {animal}",
-                            callback_data=f"volunteer_info_{code}"
-                        )
-                    ])
-
-                buttons.append([InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')])
+            if not volunteers:
+                buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
                 reply_markup = InlineKeyboardMarkup(buttons)
-
                 await self.safe_edit_message(
                     context,
                     chat_id,
                     main_message_id,
-                    message,
-                    reply_markup,
-                    parse_mode="HTML"
+                    "📝 Список волонтёров пуст.",
+                    reply_markup
                 )
+                return
+
+            message = "📋 <b>Список волонтёров:</b>\n\n"
+            buttons = []
+                
+            current_group = None
+            for volunteer_group_id, code, animal, group, full_name, marks_count in volunteers:
+                if current_group != group:
+                    current_group = group
+                    message += f"\n<b>Группа {group}:</b>\n"
+
+                message += f"👤 {animal} ({code}) - {full_name} - {marks_count} отметок\n"
+                    
+                buttons.append([
+                    InlineKeyboardButton(
+                        f"{group} | {animal}",
+                        callback_data=f"volunteer_info_{code}"
+                    )
+                ])
+
+            nav_buttons = []
+            first, last = volunteers[0], volunteers[-1]
+            if has_prev:
+                nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"volunteers_prev_{first[3]}_{first[0]}"))
+            if has_next:
+                nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"volunteers_next_{last[3]}_{last[0]}"))
+            if nav_buttons:
+                buttons.append(nav_buttons)
+
+            buttons.append([InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')])
+            reply_markup = InlineKeyboardMarkup(buttons)
+
+            await self.safe_edit_message(
+                context,
+                chat_id,
+                main_message_id,
+                message,
+                reply_markup,
+                parse_mode="HTML"
+            )
 
         except Exception as e:
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
@@ -1177,65 +3106,54 @@ class Bot:
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
         try:
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT 
-                        u.telegram_tag,
-                        u.unique_code,
-                        u.animal_code,
-                        vg.volunteer_group,
-                        u.id,
-                        u.full_name
-                    FROM Users u
-                    JOIN VolunteerGroups vg ON vg.user_id = u.id
-                    WHERE u.unique_code = ?
-                ''', (volunteer_code,))
-                volunteer = cursor.fetchone()
+            volunteer = await self.db.fetchone('''
+                SELECT 
+                    u.telegram_tag,
+                    u.unique_code,
+                    u.animal_code,
+                    vg.volunteer_group,
+                    vg.marks_count,
+                    u.full_name
+                FROM Users u
+                JOIN VolunteerGroups vg ON vg.user_id = u.id
+                WHERE u.unique_code = ?
+            ''', (volunteer_code,))
 
-                if not volunteer:
-                    await query.answer("❌ Волонтёр не найден", show_alert=True)
-                    return
+            if not volunteer:
+                await query.answer("❌ Волонтёр не найден", show_alert=True)
+                return
 
-                tag, code, animal, group, user_id_db, full_name = volunteer
-                condition_field = self.GROUP_TO_CONDITION[group]
-                activity_name = self.get_activity_name(condition_field)
+            tag, code, animal, group, marks_count, full_name = volunteer
+            condition_field = self.GROUP_TO_CONDITION[group]
+            activity_name = self.get_activity_name(condition_field)
 
-                cursor.execute(f'''
-                    SELECT COUNT(*) 
-                    FROM ContestLogs 
-                    WHERE {condition_field} = 1
-                    AND telegram_tag = ?
-                ''', (tag,))
-                marks_count = cursor.fetchone()[0]
-
-                message = f"ℹ️ <b>Информация о волонтёре:</b>\n\n"
-                message += f"🏷 Позывной: <code>{animal}</code>\n"
-                message += f"🔢 Код: <code>{code}</code>\n"
-                message += f"👤 Тег: {tag}\n"
-                message += f"📍 Группа: {group}\n"
-                message += f"📛 ФИО: {full_name}\n"
-                message += f"🎯 Активность: {activity_name}\n"
-                message += f"📊 Количество отметок: {marks_count}\n"
+            message = f"ℹ️ <b>Информация о волонтёре:</b>\n\n"
+            message += f"🏷 Позывной: <code>{animal}</code>\n"
+            message += f"🔢 Код: <code>{code}</code>\n"
+            message += f"👤 Тег: {tag}\n"
+            message += f"📍 Группа: {group}\n"
+            message += f"📛 ФИО: {full_name}\n"
+            message += f"🎯 Активность: {activity_name}\n"
+            message += f"📊 Количество отметок: {marks_count}\n"
 
-                buttons = [
-                    [InlineKeyboardButton("❌ Снять с роли волонтёра", callback_data=f"remove_volunteer_{code}")],
-                    [InlineKeyboardButton("↩️ К списку волонтёров", callback_data="show_volunteers")],
-                    [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data="return_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(buttons)
+            buttons = [
+                [InlineKeyboardButton("❌ Снять с роли волонтёра", callback_data=f"remove_volunteer_{code}")],
+                [InlineKeyboardButton("↩️ К списку волонтёров", callback_data="show_volunteers")],
+                [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data="return_to_main")]
+            ]
+            reply_markup = InlineKeyboardMarkup(buttons)
 
-                await self.safe_edit_message(
-                    context,
-                    chat_id,
-                    main_message_id,
-                    message,
-                    reply_markup,
-                    parse_mode="HTML"
-                )
+            await self.safe_edit_message(
+                context,
+                chat_id,
+                main_message_id,
+                message,
+                reply_markup,
+                parse_mode="HTML"
+            )
 
         except Exception as e:
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
@@ -1252,41 +3170,30 @@ class Bot:
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
 
-        if self.get_user_role(user_id) != 'Организатор':
+        if await self.get_user_role(user_id) != 'Организатор':
             await query.answer("⛔ У вас нет прав для этого действия", show_alert=True)
             return
 
         try:
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT u.animal_code, u.id, vg.volunteer_group
-                    FROM Users u
-                    LEFT JOIN VolunteerGroups vg ON vg.user_id = u.id
-                    WHERE u.unique_code = ?
-                ''', (volunteer_code,))
-                result = cursor.fetchone()
-                
-                if not result:
-                    await query.answer("❌ Волонтёр не найден", show_alert=True)
-                    return
+            result = await self.db.fetchone('''
+                SELECT u.animal_code, u.id, vg.volunteer_group
+                FROM Users u
+                LEFT JOIN VolunteerGroups vg ON vg.user_id = u.id
+                WHERE u.unique_code = ?
+            ''', (volunteer_code,))
+            
+            if not result:
+                await query.answer("❌ Волонтёр не найден", show_alert=True)
+                return
 
-                animal_code, vol_user_id, volunteer_group = result
+            animal_code, vol_user_id, volunteer_group = result
 
-                cursor.execute('DELETE FROM VolunteerGroups WHERE user_id = ?', (vol_user_id,))
-                
-                cursor.execute('''
-                    UPDATE Users 
-                    SET role = 'Пользователь'
-                    WHERE id = ?
-                ''', (vol_user_id,))
-                
-                conn.commit()
+            volunteer_telegram_id = await self.db.run(self.demote_volunteer, vol_user_id)
+            self.profiles.invalidate(volunteer_telegram_id)
 
-            self.log_action(
+            await self.log_action(
                 user_id,
                 f"Удалил роль волонтёра у пользователя {animal_code} ({volunteer_code}) из группы {volunteer_group}"
             )
@@ -1316,276 +3223,298 @@ class Bot:
                 reply_markup
             )
 
-    async def stat_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def stat_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE, scope: str = 'all', page: int = 1):
         user_id = update.effective_user.id
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
         
         if not main_message_id:
             await update.message.reply_text("Ошибка: не найдено главное сообщение. Используйте /start для начала работы.")
             return
             
-        role = self.get_user_role(user_id)
+        role = await self.get_user_role(user_id)
         
         if role != 'Организатор':
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=main_message_id,
-                text="⛔ У вас нет доступа к этой команде.",
-                reply_markup=reply_markup
+            await self.safe_edit_message(
+                context,
+                update.effective_chat.id,
+                main_message_id,
+                "⛔ У вас нет доступа к этой команде.",
+                reply_markup
             )
             return
 
-        self.log_action(user_id, "Использована команда /stat")
-        
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT 
-                    cl.animal_code,
-                    cl.telegram_tag,
-                    (cl.condition1 + cl.condition2 + cl.condition3) as completed_conditions
-                FROM ContestLogs cl
-                ORDER BY completed_conditions DESC
-                LIMIT 10
-            ''')
-            stats = cursor.fetchall()
-
-        if not stats:
+        if scope == 'all' and page == 1:
+            await self.log_action(user_id, "Использована команда /stat")
+
+        # Страница читается из таблицы лидеров в памяти, без запроса к БД
+        offset = (page - 1) * self.STAT_PAGE_SIZE
+        if scope == 'all':
+            stats = self.leaderboard.top(offset, self.STAT_PAGE_SIZE)
+            total = self.leaderboard.total()
+            title = "📊 Статистика конкурса:"
+        else:
+            bit = self.CONDITION_BITS[scope]
+            stats = self.leaderboard.activity(bit, offset, self.STAT_PAGE_SIZE)
+            total = self.leaderboard.total(bit)
+            title = f"📊 Прошли активность «{self.get_activity_name(scope)}» ({total}):"
+
+        if not stats and scope == 'all':
             buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
             reply_markup = InlineKeyboardMarkup(buttons)
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=main_message_id,
-                text="Статистика пока отсутствует.",
-                reply_markup=reply_markup
+            await self.safe_edit_message(
+                context,
+                update.effective_chat.id,
+                main_message_id,
+                "Статистика пока отсутствует.",
+                reply_markup
             )
             return
 
-        response = "📊 Статистика конкурса:\n\n"
-        for animal_code, telegram_tag, completed in stats:
-            response += f"🏷 {animal_code} | {telegram_tag or 'Нет тега'} | {completed}/3 ✅ \n\n"
-        
-        buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
+        response = f"{title}\n\n"
+        for position, (animal_code, telegram_tag, completed) in enumerate(stats, offset + 1):
+            response += f"{position}. 🏷 {animal_code} | {telegram_tag or 'Нет тега'} | {completed}/{self.ACTIVITIES_TOTAL} ✅ \n\n"
+
+        total_pages = math.ceil(total / self.STAT_PAGE_SIZE)
+        buttons = []
+        nav_buttons = []
+
+        if page > 1:
+            nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f'stat_page_{scope}_{page-1}'))
+        if page < total_pages:
+            nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f'stat_page_{scope}_{page+1}'))
+
+        if nav_buttons:
+            buttons.append(nav_buttons)
+
+        scope_buttons = [
+            InlineKeyboardButton(
+                f"{'• ' if group_scope == scope else ''}{group}",
+                callback_data=f'stat_page_{group_scope}_1'
+            )
+            for group, group_scope in sorted(self.GROUP_TO_CONDITION.items())
+        ]
+        buttons.append(scope_buttons)
+        buttons.append([InlineKeyboardButton(f"{'• ' if scope == 'all' else ''}Общий зачёт", callback_data='stat_page_all_1')])
+        buttons.append([InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')])
         reply_markup = InlineKeyboardMarkup(buttons)
         
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=main_message_id,
-            text=response,
-            reply_markup=reply_markup
+        await self.safe_edit_message(
+            context,
+            update.effective_chat.id,
+            main_message_id,
+            response,
+            reply_markup
+        )
+
+    def build_callback_router(self):
+        router = CallbackRouter()
+        router.exact('return_to_main', self.return_to_main)
+        cancel_mark = lambda update, context, *mark: self.cancel_action(update, context, 'mark', *mark)
+        router.exact('cancel_mark_condition', cancel_mark, needs_main_message=False)
+        router.prefix('cancel_mark_condition_', cancel_mark, parse=self.parse_mark_payload, needs_main_message=False)
+        router.exact(
+            'cancel_add_volunteer',
+            lambda update, context: self.cancel_action(update, context, 'add_volunteer'),
+            needs_main_message=False
         )
+        router.exact('show_status', self.show_user_status)
+        router.prefix('mark_user_', self.handle_mark_user_callback)
+        router.prefix('unmark_user_', self.handle_unmark_user_callback, parse=self.parse_mark_payload)
+        router.exact('show_volunteers', self.show_volunteers_list)
+        router.prefix('volunteers_', self.show_volunteers_list, parse=self.parse_volunteers_page)
+        router.prefix('volunteer_info_', self.show_volunteer_info)
+        router.prefix('remove_volunteer_', self.remove_volunteer_role)
+        router.exact('get_map', self.send_map)
+        router.exact('run_raffle', self.run_raffle)
+        router.exact('new_raffle', self.run_raffle)
+        router.prefix('raffle_page_', self.show_raffle_results, parse=int)
+        router.exact('get_event1', self.send_event_info)
+        router.exact('get_stat', self.stat_command)
+        router.prefix('stat_page_', self.stat_command, parse=self.parse_stat_page)
+        router.exact('add_volunteer', lambda update, context: self.show_command_hint(
+            update, context, "Введите команду /add_volunteer <код или позывной> <группа>"
+        ))
+        router.exact('mark_condition', lambda update, context: self.show_command_hint(
+            update, context, "Введите команду /mark <код или позывной> <условие>"
+        ))
+        router.exact('unmark_condition', self.show_unmark_hint)
+        return router
+
+    def parse_volunteers_page(self, payload):
+        direction, group, vg_id = payload.split('_', 2)
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return direction, group, int(vg_id)
+
+    def parse_mark_payload(self, payload):
+        # <conditionN>_<код пользователя>
+        condition_field, unique_code = payload.split('_', 1)
+        if condition_field not in self.CONDITION_BITS:
+            raise ValueError(condition_field)
+        return condition_field, unique_code
+
+    def parse_stat_page(self, payload):
+        scope, page = payload.rsplit('_', 1)
+        if scope != 'all' and scope not in self.CONDITION_BITS:
+            raise ValueError(scope)
+        return scope, int(page)
 
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        route, args = self.callback_router.resolve(query.data)
+        if route is None:
+            await query.answer()
+            return
+
+        # Главное сообщение проверяется только для маршрутов, которые его редактируют
+        if route.needs_main_message and not await self.get_main_message_id(query.from_user.id):
+            await query.answer("Ошибка: не найдено главное сообщение", show_alert=True)
+            return
+
+        await self.callback_router.call(route, args, update, context)
+
+    async def return_to_main(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         user_id = query.from_user.id
         chat_id = query.message.chat.id
+        profile = await self.get_profile(user_id)
+        main_message_id, map_message_id, event_message_id = profile.main_message_id, profile.map_message_id, profile.event_message_id
 
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT main_message_id, map_message_id, event_message_id FROM UserMainMessages WHERE telegram_id = ?', (user_id,))
-            row = cursor.fetchone()
-            if row:
-                main_message_id, map_message_id, event_message_id = row
-            else:
-                await query.answer("Ошибка: не найдено главное сообщение", show_alert=True)
-                return
+        if map_message_id:
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=map_message_id)
+                await self.db.execute('UPDATE UserMainMessages SET map_message_id = NULL WHERE telegram_id = ?', (user_id,))
+                self.profiles.update(user_id, map_message_id=None)
+            except Exception as e:
+                print(f"Ошибка при удалении карты: {e}")
 
-        if query.data == 'return_to_main':
-            if map_message_id:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=map_message_id)
-                    cursor.execute('UPDATE UserMainMessages SET map_message_id = NULL WHERE telegram_id = ?', (user_id,))
-                    conn.commit()
-                except Exception as e:
-                    print(f"Ошибка при удалении карты: {e}")
+        if event_message_id:
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=event_message_id)
+                await self.db.execute('UPDATE UserMainMessages SET event_message_id = NULL WHERE telegram_id = ?', (user_id,))
+                self.profiles.update(user_id, event_message_id=None)
+            except Exception as e:
+                print(f"Ошибка при удалении сообщения о мероприятии: {e}")
 
-            if event_message_id:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=event_message_id)
-                    cursor.execute('UPDATE UserMainMessages SET event_message_id = NULL WHERE telegram_id = ?', (user_id,))
-                    conn.commit()
-                except Exception as e:
-                    print(f"Ошибка при удалении сообщения о мероприятии: {e}")
+        welcome_message, reply_markup = await self.render_main_menu(user_id)
 
-            role = self.get_user_role(user_id)
-            cursor.execute('''
-                SELECT cl.animal_code, u.unique_code, cl.condition1, cl.condition2, cl.condition3 
-                FROM ContestLogs cl
-                JOIN Users u ON u.telegram_tag = cl.telegram_tag
-                WHERE u.telegram_id = ?
-            ''', (user_id,))
-            animal_code, unique_code, *conditions = cursor.fetchone()
+        await self.safe_edit_message(
+            context,
+            chat_id,
+            main_message_id,
+            welcome_message,
+            reply_markup
+        )
 
-            welcome_message = self.welc_msg(animal_code, unique_code)
+    async def send_map(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        user_id = query.from_user.id
+        chat_id = query.message.chat.id
+        profile = await self.get_profile(user_id)
+        main_message_id = profile.main_message_id
 
-            buttons = [
-                [InlineKeyboardButton("О мероприятии", callback_data='get_event1')],
-            ]
-            
-            if sum(conditions) < 3 and role != 'Организатор' and role != 'Волонтёр':
-                buttons.append([InlineKeyboardButton("Получить карту", callback_data='get_map')])
-                completed_conditions = sum(conditions)
-                if completed_conditions == 3:
-                    progress_msg = "\n🎉 Вы прошли все активности"
-                else:
-                    progress_msg = f"\n🎈 Вы прошли {completed_conditions} из 3 активностей."
-                welcome_message += progress_msg
-        
-            
-            if role == 'Организатор':
-                buttons.append([InlineKeyboardButton("Получить статистику", callback_data='get_stat')])
-                buttons.append([InlineKeyboardButton("👥 Список волонтёров", callback_data='show_volunteers')])
-                buttons.append([InlineKeyboardButton("Добавить волонтера", callback_data='add_volunteer')])
-                buttons.append([InlineKeyboardButton("Отметить условие", callback_data='mark_condition')])
-                buttons.append([InlineKeyboardButton("Отменить отметку", callback_data='unmark_condition')])
-                buttons.append([InlineKeyboardButton("🎲 Провести розыгрыш", callback_data='run_raffle')])
-            elif role == 'Волонтёр':
-                buttons.append([InlineKeyboardButton("Отметить условие", callback_data='mark_condition')])
-                buttons.append([InlineKeyboardButton("Отменить отметку", callback_data='unmark_condition')])
-
-            if role == 'Пользователь':
-                buttons.append([InlineKeyboardButton("📊 Мой статус", callback_data='show_status')])
+        buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
+        reply_markup = InlineKeyboardMarkup(buttons)
 
-            reply_markup = InlineKeyboardMarkup(buttons)
+        progress = await self.db.fetchone('''
+            SELECT cl.progress FROM ContestLogs cl
+            JOIN Users u ON u.id = cl.user_id
+            WHERE u.telegram_id = ?
+        ''', (user_id,))
 
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=main_message_id,
-                text=welcome_message,
-                reply_markup=reply_markup
-            )
+        image_path = 'MAP.jpeg'
 
-        elif query.data == 'cancel_mark_condition':
-            await self.cancel_action(update, context, 'mark')
-        elif query.data.startswith('cancel_mark_condition_'):
-            await self.cancel_action(update, context, 'mark')
-        elif query.data == 'cancel_add_volunteer':
-            await self.cancel_action(update, context, 'add_volunteer')
-        elif query.data == 'show_status':
-            await self.show_user_status(update, context)
-        elif query.data.startswith('mark_user_'):
-            unique_code = query.data.replace('mark_user_', '')
-            await self.handle_mark_user_callback(update, context, unique_code)
-        elif query.data.startswith('unmark_user_'):
-            data = query.data.replace('unmark_user_', '')
-            await self.handle_unmark_user_callback(update, context, data)
-        elif query.data == 'show_volunteers':
-            await self.show_volunteers_list(update, context)
-        elif query.data.startswith('volunteer_info_'):
-            volunteer_code = query.data.replace('volunteer_info_', '')
-            await self.show_volunteer_info(update, context, volunteer_code)
-        elif query.data.startswith('remove_volunteer_'):
-            volunteer_code = query.data.replace('remove_volunteer_', '')
-            await self.remove_volunteer_role(update, context, volunteer_code)
-        elif query.data == 'get_map':
-            buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
-            reply_markup = InlineKeyboardMarkup(buttons)
+        sent_message = await self.send_cached_photo(
+            context,
+            chat_id,
+            image_path,
+            caption=self.crd_msg(progress[0] if progress else 0),
+            reply_markup=reply_markup,
+            parse_mode="HTML"
+        )
 
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT condition1, condition2, condition3 FROM ContestLogs cl
-                    JOIN Users u ON u.telegram_tag = cl.telegram_tag
-                    WHERE u.telegram_id = ?
-                ''', (user_id,))
-                conditions = cursor.fetchone()
+        await self.db.execute('UPDATE UserMainMessages SET map_message_id = ? WHERE telegram_id = ?', (sent_message.message_id, user_id))
+        self.profiles.update(user_id, map_message_id=sent_message.message_id)
 
-            image_path = 'MAP.jpeg'
+        await self.safe_edit_message(
+            context,
+            chat_id,
+            main_message_id,
+            "🔽 Карта доступна внизу."
+        )
 
-            sent_message = await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=open(image_path, 'rb'),
-                caption=self.crd_msg(conditions),
-                reply_markup=reply_markup,
-                parse_mode="HTML"
-            )
+    async def send_event_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        user_id = query.from_user.id
+        chat_id = query.message.chat.id
+        profile = await self.get_profile(user_id)
+        main_message_id = profile.main_message_id
 
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('UPDATE UserMainMessages SET map_message_id = ? WHERE telegram_id = ?', (sent_message.message_id, user_id))
-                conn.commit()
+        buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
+        reply_markup = InlineKeyboardMarkup(buttons)
 
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=main_message_id,
-                text="🔽 Карта доступна внизу.",
-                reply_markup=None
-            )
-        elif query.data == 'run_raffle':
-            await self.run_raffle(update, context)
-        elif query.data == 'new_raffle':
-            await self.run_raffle(update, context)
-        elif query.data.startswith('raffle_page_'):
-            page = int(query.data.replace('raffle_page_', ''))
-            await self.show_raffle_results(update, context, page)
-        elif query.data == 'get_event1':
-            buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
-            reply_markup = InlineKeyboardMarkup(buttons)
+        image_path = 'EVENT1.jpeg'
 
-            image_path = 'EVENT1.jpeg'
+        sent_message = await self.send_cached_photo(
+            context,
+            chat_id,
+            image_path,
+            caption="ℹ️ <b>О мероприятии:</b>\nМероприятие будет проходить в формате ...",
+            reply_markup=reply_markup,
+            parse_mode="HTML"
+        )
 
-            sent_message = await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=open(image_path, 'rb'),
-                caption="ℹ️ <b>О мероприятии:</b>\nМероприятие будет проходить в формате ...",
-                reply_markup=reply_markup,
-                parse_mode="HTML"
-            )
+        await self.db.execute('UPDATE UserMainMessages SET event_message_id = ? WHERE telegram_id = ?', (sent_message.message_id, user_id))
+        self.profiles.update(user_id, event_message_id=sent_message.message_id)
 
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                cursor.execute('UPDATE UserMainMessages SET event_message_id = ? WHERE telegram_id = ?', (sent_message.message_id, user_id))
-                conn.commit()
+        await self.safe_edit_message(
+            context,
+            chat_id,
+            main_message_id,
+            "ℹ️ Информация о мероприятии доступна внизу."
+        )
 
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=main_message_id,
-                text="ℹ️ Информация о мероприятии доступна внизу.",
-                reply_markup=None
-            )
-        elif query.data == 'get_stat':
-            await self.stat_command(update, context)
-        elif query.data == 'add_volunteer':
-            buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
-            reply_markup = InlineKeyboardMarkup(buttons)
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=main_message_id,
-                reply_markup=reply_markup,
-                text="Введите команду /add_volunteer <код или позывной> <группа>"
+    async def show_command_hint(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        query = update.callback_query
+        buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
+        reply_markup = InlineKeyboardMarkup(buttons)
+        await self.safe_edit_message(
+            context,
+            query.message.chat.id,
+            await self.get_main_message_id(query.from_user.id),
+            text,
+            reply_markup
+        )
+
+    async def show_unmark_hint(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        user_id = query.from_user.id
+        chat_id = query.message.chat.id
+        profile = await self.get_profile(user_id)
+        main_message_id = profile.main_message_id
+
+        buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
+        reply_markup = InlineKeyboardMarkup(buttons)
+        role = await self.get_user_role(user_id)
+        
+        if role == 'Организатор':
+            message = (
+                f"Введите команду /unmark <код или позывной> <группа>\nДоступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}\nПример: /unmark Лиса#1 А"
             )
-        elif query.data == 'mark_condition':
-            buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
-            reply_markup = InlineKeyboardMarkup(buttons)
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=main_message_id,
-                reply_markup=reply_markup,
-                text="Введите команду /mark <код или позывной> <условие>"
+        else:
+            message = (
+                f"Введите команду /unmark <код или позывной>\nПример: /unmark Лиса#123"
             )
-        elif query.data == 'unmark_condition':
-            buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
-            reply_markup = InlineKeyboardMarkup(buttons)
-            role = self.get_user_role(user_id)
-            
-            if role == 'Организатор':
-                message = (
-                    f"Введите команду /unmark <код или позывной> <группа>\nДоступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}\nПример: /unmark Лиса#1 А"
-                )
-            else:
-                message = (
-                    f"Введите команду /unmark <код или позывной>\nПример: /unmark Лиса#123"
-                )
-            
-            await self.safe_edit_message(
-                context,
-                chat_id,
-                main_message_id,
-                message,
-                reply_markup
-            )            
+        
+        await self.safe_edit_message(
+            context,
+            chat_id,
+            main_message_id,
+            message,
+            reply_markup
+        )
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
@@ -1597,7 +3526,7 @@ class Bot:
             return
             
         # Check for command spam
-        is_spam, spam_message = self.check_command_spam(user_id, "start")
+        is_spam, spam_message = await self.check_command_spam(user_id, "start")
         if is_spam:
             await update.message.reply_text(spam_message)
             return
@@ -1609,77 +3538,51 @@ class Bot:
         username = update.effective_user.username or "Unknown"
         telegram_tag = f"@{username}" if username else None
 
-        self.add_user(user_id, username, telegram_tag)
-        self.log_action(user_id, "Использована команда /start")
-        
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT cl.animal_code, u.unique_code, cl.condition1, cl.condition2, cl.condition3, 
-                       cl.condition4, cl.condition5 
-                FROM ContestLogs cl
-                JOIN Users u ON u.telegram_tag = cl.telegram_tag
-                WHERE u.telegram_id = ?
-            ''', (user_id,))
-            animal_code, unique_code, *conditions = cursor.fetchone()
-
-        welcome_message = self.welc_msg(animal_code, unique_code)
+        await self.db.run(self.add_user, user_id, username, telegram_tag)
+        self.profiles.invalidate(user_id)
+        await self.log_action(user_id, "Использована команда /start")
         
-        role = self.get_user_role(user_id)
-        buttons = [
-            [InlineKeyboardButton("О мероприятии", callback_data='get_event1')],
-        ]
-
-        if role == 'Пользователь':
-            buttons.append([InlineKeyboardButton("📊 Мой статус", callback_data='show_status')])
-
-        if sum(conditions) < 5 and role != 'Организатор' and role != 'Волонтёр':
-            buttons.append([InlineKeyboardButton("Получить карту", callback_data='get_map')])
-            completed_conditions = sum(conditions)
-            if completed_conditions == 5:
-                progress_msg = "\n🎉 Вы прошли все активности"
-            else:
-                progress_msg = f"\n🎈 Вы прошли {completed_conditions} из 5 активностей."
-            welcome_message += progress_msg
-            
-        
-        if role == 'Организатор':
-            buttons.append([InlineKeyboardButton("Получить статистику", callback_data='get_stat')])
-            buttons.append([InlineKeyboardButton("👥 Список волонтёров", callback_data='show_volunteers')])
-            buttons.append([InlineKeyboardButton("Добавить волонтера", callback_data='add_volunteer')])
-            buttons.append([InlineKeyboardButton("Отметить условие", callback_data='mark_condition')])
-            buttons.append([InlineKeyboardButton("Отменить отметку", callback_data='unmark_condition')])
-            buttons.append([InlineKeyboardButton("🎲 Провести розыгрыш", callback_data='run_raffle')])
-        elif role == 'Волонтёр':
-            buttons.append([InlineKeyboardButton("Отметить условие", callback_data='mark_condition')])
-            buttons.append([InlineKeyboardButton("Отменить отметку", callback_data='unmark_condition')])
-
-        reply_markup = InlineKeyboardMarkup(buttons)
+        welcome_message, reply_markup = await self.render_main_menu(user_id)
         message = await update.message.reply_text(welcome_message, reply_markup=reply_markup)
         
-        with sqlite3.connect('bot_database.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO UserMainMessages (telegram_id, main_message_id)
-                VALUES (?, ?)
-            ''', (user_id, message.message_id))
-            conn.commit()
+        await self.db.execute('''
+            INSERT OR REPLACE INTO UserMainMessages (telegram_id, main_message_id)
+            VALUES (?, ?)
+        ''', (user_id, message.message_id))
+        self.profiles.invalidate(user_id)
 
         try:
             await update.message.delete()
         except Exception as e:
             print(f"Ошибка при удалении сообщения с командой: {e}")
 
+    def assign_volunteer(self, user_db_id, volunteer_group, full_name):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            row = cursor.execute('''
+                UPDATE Users 
+                SET role = 'Волонтёр', full_name = ?
+                WHERE id = ?
+                RETURNING telegram_id
+            ''', (full_name, user_db_id)).fetchone()
+
+            cursor.execute('DELETE FROM VolunteerGroups WHERE user_id = ?', (user_db_id,))
+            cursor.execute('''
+                INSERT INTO VolunteerGroups (user_id, volunteer_group, marks_count)
+                VALUES (?, ?, (SELECT COUNT(*) FROM ContestMarks WHERE author_id = ?))
+            ''', (user_db_id, volunteer_group, user_db_id))
+            return row[0] if row else None
+
     async def add_volunteer_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
         reply_markup = InlineKeyboardMarkup(buttons)
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
         if not main_message_id:
             await update.message.reply_text("Ошибка: не найдено главное сообщение. Используйте /start для начала работы.")
             return
         
-        if self.get_user_role(user_id) != 'Организатор':
+        if await self.get_user_role(user_id) != 'Организатор':
             await self.safe_edit_message(
                 context,
                 update.effective_chat.id,
@@ -1733,64 +3636,49 @@ class Bot:
                     print(f"Ошибка при удалении сообщения с командой: {e}")
                 return
 
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-
-                cursor.execute('''
-                    SELECT id, telegram_tag 
-                    FROM Users 
-                    WHERE LOWER(unique_code) = ? OR LOWER(animal_code) = ?
-                ''', (volunteer_code_or_call_sign, volunteer_code_or_call_sign))
-                user_data = cursor.fetchone()
-
-                if not user_data:
-                    await self.safe_edit_message(
-                        context,
-                        update.effective_chat.id,
-                        main_message_id,
-                        "❌ Указанный пользователь не найден.",
-                        reply_markup,
-                        parse_mode="HTML"
-                    )
-                    return
-
-                user_id_db, telegram_tag = user_data
-
-                cursor.execute('''
-                    UPDATE Users 
-                    SET role = 'Волонтёр', full_name = ?
-                    WHERE id = ?
-                ''', (full_name, user_id_db))
-
-                cursor.execute('DELETE FROM VolunteerGroups WHERE user_id = ?', (user_id_db,))
-                cursor.execute('''
-                    INSERT INTO VolunteerGroups (user_id, volunteer_group)
-                    VALUES (?, ?)
-                ''', (user_id_db, volunteer_group))
-
-                conn.commit()
-
-                self.log_action(user_id, f"Добавлен волонтер (Код или позывной: {volunteer_code_or_call_sign}) в группу {volunteer_group} с ФИО {full_name}")
-
-                buttons = [
-                    [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')],
-                    [InlineKeyboardButton("❌ Отмена добавления", callback_data='cancel_add_volunteer')]
-                ]
-                reply_markup = InlineKeyboardMarkup(buttons)
+            user_data = await self.db.fetchone('''
+                SELECT id, telegram_tag 
+                FROM Users 
+                WHERE unique_code = ? OR animal_code = ?
+            ''', (volunteer_code_or_call_sign, volunteer_code_or_call_sign))
 
+            if not user_data:
                 await self.safe_edit_message(
                     context,
                     update.effective_chat.id,
                     main_message_id,
-                    (
-                        f"✅ Успешно добавлен волонтер!\n"
-                        f"Код или позывной: {volunteer_code_or_call_sign}\n"
-                        f"Группа: {volunteer_group}\n"
-                        f"ФИО: {full_name}"
-                    ),
+                    "❌ Указанный пользователь не найден.",
                     reply_markup,
                     parse_mode="HTML"
                 )
+                return
+
+            user_id_db, telegram_tag = user_data
+
+            volunteer_telegram_id = await self.db.run(self.assign_volunteer, user_id_db, volunteer_group, full_name)
+            self.profiles.invalidate(volunteer_telegram_id)
+
+            await self.log_action(user_id, f"Добавлен волонтер (Код или позывной: {volunteer_code_or_call_sign}) в группу {volunteer_group} с ФИО {full_name}")
+
+            buttons = [
+                [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')],
+                [InlineKeyboardButton("❌ Отмена добавления", callback_data='cancel_add_volunteer')]
+            ]
+            reply_markup = InlineKeyboardMarkup(buttons)
+
+            await self.safe_edit_message(
+                context,
+                update.effective_chat.id,
+                main_message_id,
+                (
+                    f"✅ Успешно добавлен волонтер!\n"
+                    f"Код или позывной: {volunteer_code_or_call_sign}\n"
+                    f"Группа: {volunteer_group}\n"
+                    f"ФИО: {full_name}"
+                ),
+                reply_markup,
+                parse_mode="HTML"
+            )
 
         except sqlite3.Error as e:
             await self.safe_edit_message(
@@ -1811,13 +3699,13 @@ class Bot:
         user_id = update.effective_user.id
         buttons = [[InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')]]
         reply_markup = InlineKeyboardMarkup(buttons)
-        main_message_id = self.get_main_message_id(user_id)
+        main_message_id = await self.get_main_message_id(user_id)
         
         if not main_message_id:
             await update.message.reply_text("Ошибка: не найдено главное сообщение. Используйте /start для начала работы.")
             return
         
-        role = self.get_user_role(user_id)
+        role = await self.get_user_role(user_id)
         if role not in ['Волонтёр', 'Организатор']:
             await self.safe_edit_message(
                 context,
@@ -1832,15 +3720,26 @@ class Bot:
                 print(f"Ошибка при удалении сообщения с командой: {e}")
             return
 
-        if role == 'Организатор' and len(context.args) != 2:
+        # Коды можно перечислять через пробел или запятую, у организатора
+        # последним аргументом идёт группа
+        code_args = context.args[:-1] if role == 'Организатор' else context.args
+        codes = list(dict.fromkeys(
+            self.standardize_call_sign(code)
+            for arg in code_args
+            for code in arg.split(',')
+            if code
+        ))
+
+        if role == 'Организатор' and (len(context.args) < 2 or not codes or len(codes) > self.MARK_BATCH_LIMIT):
             await self.safe_edit_message(
                 context,
                 update.effective_chat.id,
                 main_message_id,
                 (
                     "❌ Неверный формат команды.\n"
-                    "Используйте: <code>/mark &lt;код или позывной&gt; &lt;группа&gt;</code>\n"
-                    f"Доступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}"
+                    "Используйте: <code>/mark &lt;код или позывной&gt; [&lt;код или позывной&gt; ...] &lt;группа&gt;</code>\n"
+                    f"Доступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}\n"
+                    f"Не больше {self.MARK_BATCH_LIMIT} кодов за раз."
                 ),
                 reply_markup,
                 parse_mode="HTML"
@@ -1850,14 +3749,15 @@ class Bot:
             except Exception as e:
                 print(f"Ошибка при удалении сообщения с командой: {e}")
             return
-        elif role == 'Волонтёр' and len(context.args) != 1:
+        elif role == 'Волонтёр' and (not codes or len(codes) > self.MARK_BATCH_LIMIT):
             await self.safe_edit_message(
                 context,
                 update.effective_chat.id,
                 main_message_id,
                 (
                     "❌ Неверный формат команды.\n"
-                    "Используйте: <code>/mark &lt;код или позывной&gt;</code>"
+                    "Используйте: <code>/mark &lt;код или позывной&gt; [&lt;код или позывной&gt; ...]</code>\n"
+                    f"Не больше {self.MARK_BATCH_LIMIT} кодов за раз."
                 ),
                 reply_markup,
                 parse_mode="HTML"
@@ -1869,110 +3769,88 @@ class Bot:
             return
 
         try:
-            target_code_or_call_sign = self.standardize_call_sign(context.args[0])
+            profile = await self.get_profile(user_id)
 
-            with sqlite3.connect('bot_database.db') as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT u.id, u.telegram_tag, cl.id as contest_log_id
-                    FROM Users u
-                    LEFT JOIN ContestLogs cl ON u.telegram_tag = cl.telegram_tag
-                    WHERE LOWER(u.unique_code) = ? OR LOWER(u.animal_code) = ?
-                ''', (target_code_or_call_sign, target_code_or_call_sign))
-                
-                target_user = cursor.fetchone()
-                if not target_user:
+            if role == "Волонтёр":
+                if not profile:
                     await self.safe_edit_message(
                         context,
                         update.effective_chat.id,
                         main_message_id,
-                        "❌ Указанный пользователь не найден.",
+                        "❌ Ошибка: пользователь не найден в базе данных.",
                         reply_markup,
                         parse_mode="HTML"
                     )
                     return
                 
-                target_user_id, target_telegram_tag, contest_log_id = target_user
-                
-                if role == "Волонтёр":
-                    cursor.execute('SELECT id FROM Users WHERE telegram_id = ?', (user_id,))
-                    user_db_id = cursor.fetchone()
-                    
-                    if not user_db_id:
-                        await self.safe_edit_message(
-                            context,
-                            update.effective_chat.id,
-                            main_message_id,
-                            "❌ Ошибка: пользователь не найден в базе данных.",
-                            reply_markup,
-                            parse_mode="HTML"
-                        )
-                        return
-                        
-                    cursor.execute('''
-                        SELECT volunteer_group 
-                        FROM VolunteerGroups 
-                        WHERE user_id = ?
-                    ''', (user_db_id[0],))
-                    volunteer_group_data = cursor.fetchone()
-                    
-                    if not volunteer_group_data:
-                        await self.safe_edit_message(
-                            context,
-                            update.effective_chat.id,
-                            main_message_id,
-                            "❌ Вы не привязаны к группе.",
-                            reply_markup,
-                            parse_mode="HTML"
-                        )
-                        return
+                if not profile.volunteer_group:
+                    await self.safe_edit_message(
+                        context,
+                        update.effective_chat.id,
+                        main_message_id,
+                        "❌ Вы не привязаны к группе.",
+                        reply_markup,
+                        parse_mode="HTML"
+                    )
+                    return
                     
-                    volunteer_group = volunteer_group_data[0]
-                    condition_field = self.GROUP_TO_CONDITION[volunteer_group]
-                else:
-                    volunteer_group = context.args[1].upper()
-                    if volunteer_group not in self.VOLUNTEER_GROUPS:
-                        await self.safe_edit_message(
-                            context,
-                            update.effective_chat.id,
-                            main_message_id,
-                            f"❌ Неверная группа. Доступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}",
-                            reply_markup,
-                            parse_mode="HTML"
-                        )
-                        return
-                    condition_field = self.GROUP_TO_CONDITION[volunteer_group]
-
-                cursor.execute(f'''
-                    UPDATE ContestLogs 
-                    SET {condition_field} = 1
-                    WHERE telegram_tag = ?
-                ''', (target_telegram_tag,))
-                
-                conn.commit()
-                
-                self.log_action(
-                    user_id,
-                    f"{role} отметил активность «{self.get_activity_name(condition_field)}» для пользователя {target_code_or_call_sign}"
-                )
+                volunteer_group = profile.volunteer_group
+                condition_field = self.GROUP_TO_CONDITION[volunteer_group]
+            else:
+                volunteer_group = context.args[-1].upper()
+                if volunteer_group not in self.VOLUNTEER_GROUPS:
+                    await self.safe_edit_message(
+                        context,
+                        update.effective_chat.id,
+                        main_message_id,
+                        f"❌ Неверная группа. Доступные группы: {', '.join(sorted(self.VOLUNTEER_GROUPS))}",
+                        reply_markup,
+                        parse_mode="HTML"
+                    )
+                    return
+                condition_field = self.GROUP_TO_CONDITION[volunteer_group]
+
+            activity_name = self.get_activity_name(condition_field)
+            results = await self.db.run(self.mark_users_bulk, profile.id, role, condition_field, codes)
+
+            if len(codes) == 1:
+                if results[0][1] == 'not_found':
+                    await self.safe_edit_message(
+                        context,
+                        update.effective_chat.id,
+                        main_message_id,
+                        "❌ Указанный пользователь не найден.",
+                        reply_markup,
+                        parse_mode="HTML"
+                    )
+                    return
 
-                
                 buttons = [
                     [InlineKeyboardButton("🔙 Вернуться в главное меню", callback_data='return_to_main')],
                     [InlineKeyboardButton("❌ Отмена отметки", callback_data='cancel_mark_condition')]
                 ]
                 reply_markup = InlineKeyboardMarkup(buttons)
-                
-                activity_name = self.get_activity_name(condition_field)
-                await self.safe_edit_message(
-                    context,
-                    update.effective_chat.id,
-                    main_message_id,
-                    f"✅ Успешно отмечена активность «{activity_name}» для пользователя {target_code_or_call_sign}",
-                    reply_markup,
-                    parse_mode="HTML"
-                )
+                message = f"✅ Успешно отмечена активность «{activity_name}» для пользователя {codes[0]}"
+            else:
+                marked = sum(1 for _, status, _ in results if status == 'marked')
+                lines = [f"📋 Активность «{activity_name}»: отмечено {marked} из {len(codes)}\n"]
+                for code, status, animal_code in results:
+                    if status == 'marked':
+                        lines.append(f"✅ {code} ({animal_code})")
+                    elif status == 'already_marked':
+                        lines.append(f"☑️ {code} ({animal_code}) — уже отмечен")
+                    else:
+                        lines.append(f"❌ {code} — не найден")
+                message = '\n'.join(lines)
+
+            await self.safe_edit_message(
+                context,
+                update.effective_chat.id,
+                main_message_id,
+                message,
+                reply_markup,
+                parse_mode="HTML"
+            )
 
         except sqlite3.Error as e:
             await self.safe_edit_message(
@@ -1989,17 +3867,220 @@ class Bot:
         except Exception as e:
             print(f"Ошибка при удалении сообщения с командой: {e}")
 
+    def mark_users_bulk(self, author_db_id, role, condition_field, codes):
+        # Все коды разрешаются одним запросом по индексам unique_code и
+        # animal_code, отметки и журнал пишутся в одной транзакции
+        bit = self.CONDITION_BITS[condition_field]
+        pending = []
+        try:
+            with self.db.connection() as conn:
+                # Буфер журнала пишется раньше собственных строк SystemActions
+                pending = self.audit.write_pending(conn)
+                placeholders = ', '.join('?' * len(codes))
+                rows = conn.execute(f'''
+                    SELECT u.id, u.unique_code, u.animal_code, cl.progress & ?
+                    FROM Users u
+                    LEFT JOIN ContestLogs cl ON cl.user_id = u.id
+                    WHERE u.unique_code IN ({placeholders}) OR u.animal_code IN ({placeholders})
+                ''', [bit, *codes, *codes]).fetchall()
+                users = {}
+                for row in rows:
+                    users[row[1]] = row
+                    users[row[2]] = row
+
+                results = []
+                to_mark = {}
+                for code in codes:
+                    row = users.get(code)
+                    if row is None:
+                        results.append((code, 'not_found', None))
+                    elif row[3] or row[0] in to_mark:
+                        results.append((code, 'already_marked', row[2]))
+                    else:
+                        to_mark[row[0]] = code
+                        results.append((code, 'marked', row[2]))
+
+                if to_mark:
+                    updated = conn.execute(f'''
+                        UPDATE ContestLogs
+                        SET progress = progress | ?, completed_count = completed_count + 1
+                        WHERE progress & ? = 0
+                        AND user_id IN ({', '.join('?' * len(to_mark))})
+                        RETURNING user_id, progress
+                    ''', [bit, bit, *to_mark]).fetchall()
+                    for row in updated:
+                        self.leaderboard.update(*row)
+                    self.record_marks(conn, bit, author_db_id, [row[0] for row in updated])
+                    activity_name = self.get_activity_name(condition_field)
+                    conn.executemany(
+                        'INSERT INTO SystemActions (author_id, action) VALUES (?, ?)',
+                        [(author_db_id, f"{role} отметил активность «{activity_name}» для пользователя {code}")
+                         for code in to_mark.values()]
+                    )
+                return results
+        except sqlite3.Error:
+            self.audit.restore(pending)
+            raise
+
     def run(self):
-        application = Application.builder().token(self.token).build()
+        if self.UPDATE_MODE == 'webhook' and not self.WEBHOOK_SECRET:
+            print("Ошибка: для режима webhook нужен BOT_WEBHOOK_SECRET")
+            self.shutdown()
+            exit(1)
+        application = (
+            Application.builder()
+            .token(self.token)
+            .update_queue(asyncio.Queue(maxsize=self.UPDATE_QUEUE_SIZE))
+            .rate_limiter(self.outbound)
+            .concurrent_updates(self.updates)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+            .build()
+        )
         # Apply rate limiting to all commands
-        application.add_handler(CommandHandler("start", self.rate_limit_command(self.start_command)))
-        application.add_handler(CommandHandler("add_volunteer", self.rate_limit_command(self.add_volunteer_command)))
-        application.add_handler(CommandHandler("mark", self.rate_limit_command(self.mark_condition_command)))
-        application.add_handler(CommandHandler("unmark", self.rate_limit_command(self.unmark_condition_command)))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_volunteer_search))
-        application.add_handler(CallbackQueryHandler(self.button_callback))
+        application.add_handler(CommandHandler("start", self.instrument_handler(
+            'start_command', self.rate_limit_command(self.start_command)
+        )))
+        application.add_handler(CommandHandler("add_volunteer", self.instrument_handler(
+            'add_volunteer_command', self.rate_limit_command(self.add_volunteer_command)
+        )))
+        application.add_handler(CommandHandler("mark", self.instrument_handler(
+            'mark_condition_command', self.rate_limit_command(self.mark_condition_command)
+        )))
+        application.add_handler(CommandHandler("unmark", self.instrument_handler(
+            'unmark_condition_command', self.rate_limit_command(self.unmark_condition_command)
+        )))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.instrument_handler(
+            'handle_volunteer_search', self.handle_volunteer_search
+        )))
+        application.add_handler(CallbackQueryHandler(self.instrument_handler('button_callback', self.button_callback)))
         print("Бот запущен...")
-        application.run_polling()
+        try:
+            if self.UPDATE_MODE == 'webhook':
+                asyncio.run(self.run_webhook(application))
+            else:
+                application.run_polling()
+        finally:
+            self.shutdown()
+
+    def register_metrics(self):
+        metrics = self.metrics
+        metrics.describe('bot_handler_seconds', 'Время обработки обновления обработчиком')
+        metrics.describe('bot_handler_errors_total', 'Исключения в обработчиках')
+        metrics.describe('bot_db_query_seconds', 'Время выполнения функции или запроса к БД')
+        metrics.describe('bot_db_errors_total', 'Ошибки при работе с БД')
+        metrics.describe('bot_db_statement_seconds', 'Время выполнения отдельного SQL-запроса')
+        metrics.describe('bot_db_statement_errors_total', 'Ошибки отдельных SQL-запросов')
+        metrics.describe('bot_callback_route_seconds', 'Время обработки callback-маршрута')
+        metrics.describe('bot_telegram_request_seconds', 'Время запроса к Bot API по методам')
+        metrics.describe('bot_telegram_queue_wait_seconds', 'Ожидание в очереди исходящих запросов')
+        metrics.add_histograms('bot_callback_route_seconds', lambda: self.callback_router.latency, label='route')
+        metrics.add_histograms('bot_telegram_request_seconds', lambda: self.outbound.latency, label='method')
+        metrics.add_histograms('bot_telegram_queue_wait_seconds', lambda: self.outbound.queue_wait)
+        metrics.add_histograms('bot_update_lock_wait_seconds', lambda: self.updates.lock_wait)
+        metrics.add_histograms('bot_update_slot_wait_seconds', lambda: self.updates.slot_wait)
+        for prefix, component in (
+            ('bot_db', self.db),
+            ('bot_rate_limiter', self.rate_limiter),
+            ('bot_call_signs', self.call_signs),
+            ('bot_unique_codes', self.unique_codes),
+            ('bot_call_sign_index', self.call_sign_index),
+            ('bot_profiles', self.profiles),
+            ('bot_media', self.media),
+            ('bot_audit', self.audit),
+            ('bot_screens', self.screens),
+            ('bot_edits', self.edits),
+            ('bot_outbound', self.outbound),
+            ('bot_updates', self.updates),
+        ):
+            metrics.add_gauges(prefix, component.stats)
+
+    def instrument_handler(self, name, func):
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            started = time.perf_counter()
+            try:
+                return await func(update, context)
+            except Exception:
+                self.metrics.inc('bot_handler_errors_total', handler=name)
+                raise
+            finally:
+                self.metrics.observe('bot_handler_seconds', time.perf_counter() - started, handler=name)
+        return wrapper
+
+    async def handle_metrics(self, headers, body):
+        return 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}, self.metrics.render().encode('utf-8')
+
+    async def on_startup(self, application):
+        self.start_periodic(self.AUDIT_FLUSH_INTERVAL, self.audit.flush)
+        self.start_periodic(self.MAINTENANCE_INTERVAL, self.maintenance_job, first=60)
+        if not self.METRICS_PORT:
+            return
+        server = HttpServer()
+        server.route('GET', '/metrics', self.handle_metrics)
+        try:
+            await server.start(self.METRICS_LISTEN, self.METRICS_PORT)
+        except OSError as e:
+            # Метрики необязательны: занятый порт не должен останавливать бота
+            logger.error(f"Не удалось запустить /metrics на порту {self.METRICS_PORT}: {e}")
+            return
+        self.metrics_server = server
+        print(f"Метрики доступны на http://{self.METRICS_LISTEN}:{self.METRICS_PORT}/metrics")
+
+    async def on_shutdown(self, application):
+        await self.stop_periodic()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+        await self.audit.flush()
+
+    def shutdown(self):
+        # Безопасно вызывать повторно: из run() и из run_bot_with_restart
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.audit.flush_sync()
+        except sqlite3.Error as e:
+            print(f"Ошибка при записи журнала действий: {e}")
+        self.db.close()
+
+    async def handle_webhook(self, application, headers, body):
+        if not self.WEBHOOK_SECRET or not hmac.compare_digest(
+            headers.get('x-telegram-bot-api-secret-token', ''), self.WEBHOOK_SECRET
+        ):
+            return 403, {}, b''
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except ValueError:
+            return 400, {}, b''
+        try:
+            application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже, обновление не теряется
+            return 503, {'Retry-After': str(self.WEBHOOK_RETRY_AFTER)}, b''
+        return 200, {}, b''
+
+    async def run_webhook(self, application):
+        server = HttpServer()
+        server.route('POST', self.WEBHOOK_PATH, lambda headers, body: self.handle_webhook(application, headers, body))
+        async with application:
+            await application.start()
+            # post_init/post_shutdown вызывает только run_polling, здесь — вручную
+            await self.on_startup(application)
+            if self.WEBHOOK_URL:
+                await application.bot.set_webhook(
+                    url=self.WEBHOOK_URL,
+                    secret_token=self.WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            await server.start(self.WEBHOOK_LISTEN, self.WEBHOOK_PORT)
+            print(f"Вебхук слушает {self.WEBHOOK_LISTEN}:{self.WEBHOOK_PORT}{self.WEBHOOK_PATH}")
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await server.stop()
+                await self.on_shutdown(application)
+                await application.stop()
 
 if __name__ == '__main__':
 
@@ -2015,11 +4096,14 @@ if __name__ == '__main__':
 
     def run_bot_with_restart():
         while True:
+            bot = None
             try:
                 logger.info("Запуск бота...")
                 bot = Bot()
                 bot.run()
             except Exception as e:
+                if bot is not None:
+                    bot.shutdown()
                 error_time = datetime.now(UTC).strftime('%Y-%m-%d %H:%M:%S')
                 error_msg = f"""
                 ⚠️ Критическая ошибка в боте: